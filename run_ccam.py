@@ -4,48 +4,235 @@ import sys
 import subprocess
 from calendar import monthrange
 import json
+import re
+import struct
+import sqlite3
+import hashlib
+import threading
+import asyncio
+import concurrent.futures
+import time
+import queue
+import errno
+import shutil
+import fnmatch
+import tarfile
+import fcntl
+import functools
+import contextlib
+import multiprocessing
+from collections.abc import Mapping, MutableMapping
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
 
 # CCAM simulation python code
 
-def main(inargs):
-    "Main CCAM simulation script"
+class RunSettings(MutableMapping):
+    "Settings of the active CCAM run.  Each thread has its own active settings."
 
-    global d
+    def __init__(self):
+        self.local = threading.local()
 
-    print("Reading arguments")
-    d = vars(inargs)
-    convert_old_settings()
-    check_inargs()
+    def current(self):
+        "Return the settings dictionary that is active in this thread"
+        if not hasattr(self.local, 'settings'):
+            self.local.settings = {}
+        return self.local.settings
 
-    print("Verify directories")
-    create_directories()
+    def activate(self, settings):
+        "Make settings active in this thread"
+        self.local.settings = settings
 
-    if d['preprocess_test'] is True:
-        print("Define preprocess settings")
-        set_preprocess_options()
+    @contextlib.contextmanager
+    def using(self, settings):
+        "Make settings active in this thread for the duration of a with block"
+        previous = self.current()
+        self.local.settings = settings
+        try:
+            yield settings
+        finally:
+            self.local.settings = previous
 
-    if d['simulation_test'] is True:
-        print("Define simulation settings")
-        set_simulation_options()
+    def __getitem__(self, key):
+        return self.current()[key]
 
-    print("Loop over simulation months")
-    for mth in range(0, d['ncountmax']):
+    def __setitem__(self, key, value):
+        self.current()[key] = value
 
-        print("----------------------------------------")
+    def __delitem__(self, key):
+        del self.current()[key]
 
-        if d['timeloop_test'] is True:
-            # Find date for downscaling
-            get_datetime()
-            print("Reading date ",d['iyr'],d['imth_2digit'])
-            d['ofile'] = dict2str('{name}.{iyr}{imth_2digit}')
-	    
-        if d['preprocess_test'] is True:	    
+    def __iter__(self):
+        return iter(self.current())
+
+    def __len__(self):
+        return len(self.current())
+
+
+d = RunSettings()
+
+# execution engine for command lines and background tasks
+engine = {'loop': None, 'cmdpool': None, 'lock': threading.Lock(), 'history': []}
+
+# background file deletion
+deletion = {'thread': None, 'lock': threading.Lock(), 'queue': queue.Queue()}
+
+# directory listings used for file existence tests
+dir_index = {'lock': threading.Lock(), 'dirs': set(), 'names': {}}
+
+# forcing directory listings and forcing files for each radiation year
+forcing = {'lock': threading.Lock(), 'dirs': {}, 'table': {}}
+forcing_key_list = ['ozone', 'co2file', 'ch4file', 'n2ofile', 'cfc11file', 'cfc12file',
+                    'cfc113file', 'hcfc22file', 'solarfile',
+                    'so2_anth', 'so2_ship', 'so2_biom', 'bc_anth', 'bc_ship', 'bc_biom',
+                    'oc_anth', 'oc_ship', 'oc_biom', 'volcano', 'dmsfile', 'dustfile']
+
+# post-processed output directories in hdir
+output_dir_list = ['OUTPUT', 'daily', 'daily_h', 'daily_t', 'cordex', 'highfreq']
+
+def main(inargs):
+    "Main CCAM simulation script"
+
+    CCAMRun(vars(inargs)).run()
+
+
+#===============================================================================
+# Run API
+#===============================================================================
+
+class MonthContext(Mapping):
+    "Immutable settings for one month of a CCAM run"
+
+    def __init__(self, settings):
+        self.settings = dict(settings)
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    def __iter__(self):
+        return iter(self.settings)
+
+    def __len__(self):
+        return len(self.settings)
+
+    def __repr__(self):
+        return 'MonthContext({0}{1})'.format(self.settings.get('iyr'), self.settings.get('imth_2digit'))
+
+
+class CCAMRun:
+    "A CCAM run defined by its configuration"
+
+    # The run changes into the working directory and runs the model with
+    # relative file names, so concurrent runs need separate processes (see
+    # start_process).  Planning with plan() does not modify any files.
+
+    def __init__(self, config):
+        self.config = vars(build_parser().parse_args([]))
+        self.config.update(config)
+        self.settings = None
+
+    @classmethod
+    def from_args(cls, argv):
+        "Create a run from command line arguments"
+        return cls(vars(build_parser().parse_args(argv)))
+
+    def prepare(self):
+        "Check the configuration and derive the run settings"
+        if self.settings is None:
+            self.settings = dict(self.config)
+            with d.using(self.settings):
+                print("Reading arguments")
+                convert_old_settings()
+                check_inargs()
+                if d['preprocess_test'] is True:
+                    print("Define preprocess settings")
+                    set_preprocess_options()
+                if d['simulation_test'] is True:
+                    print("Define simulation settings")
+                    set_simulation_options()
+                if d['timeloop_test'] is True:
+                    print("Resolve forcing files")
+                    resolve_forcing_files()
+        return self.settings
+
+    def plan(self, nmonths=None):
+        "Return the MonthContext of each remaining month of the run"
+        settings = dict(self.prepare())
+        months = []
+        with d.using(settings):
+            read_yearqm()
+            while (nmonths is None) or (len(months) < nmonths):
+                sdate = d['iyr']*10000 + d['imth']*100 + d['iday']
+                if sdate > d['iye']*10000 + d['ime']*100 + d['ide']:
+                    break
+                set_month_dates()
+                months.append(MonthContext(settings))
+                d['iday'] = 1
+                d['imth'] = d['imth'] + 1
+                if d['imth'] > 12:
+                    d['imth'] = 1
+                    d['iyr'] = d['iyr'] + 1
+        return months
+
+    def run(self):
+        "Run ncountmax months of the simulation, post-processing or preprocessing"
+        with d.using(self.prepare()):
+
+            print("Verify directories")
+            create_directories()
+
+            print("Loop over simulation months")
+            for mth in range(0, d['ncountmax']):
+
+                print("----------------------------------------")
+
+                if d['timeloop_test'] is True:
+                    # Find date for downscaling.  With --localdir, year.qm is
+                    # written by the background copy-back, so the date of the
+                    # following months is kept from update_monthyear
+                    readqm = (mth == 0) or (d['localdir'] == "none") or (d['simulation_test'] is False)
+                    get_datetime(readqm)
+                    print("Reading date ",d['iyr'],d['imth_2digit'])
+
+                self.run_month()
+
+            print("----------------------------------------")
+            print("Simulation loop completed")
+
+            wait_for_landuse_lookahead()
+            wait_for_mesonest_prefetch()
+            wait_for_post_process()
+            wait_for_copy_back()
+
+            print("Longest running commands")
+            report_cmdline_history()
+
+            wait_for_deletions()
+
+            # Check if restart is required
+            print("Update simulation restart status")
+            restart_flag()
+
+            print("Script completed sucessfully")
+
+    def run_month(self, context=None):
+        "Run one month, using the active settings or a copy of context"
+        if context is not None:
+            d.current().update(context)
+
+        if d['preprocess_test'] is True:
             # Create surface files if needed
+            refresh_dir_index(['{hdir}/vegdata', '{wdir}'])
             check_surface_files()
 
         if d['simulation_test'] is True:
             # Define input and output files
             print("Define input and output filenames")
+            refresh_dir_index(['{bcdir}', '{wdir}', '{hdir}/vegdata', '{hdir}/RESTART'] +
+                              ['{hdir}/'+dirname for dirname in output_dir_list])
             prep_iofiles()
             locate_tracer_emissions()
             # Determine model parameters
@@ -71,25 +258,39 @@ def main(inargs):
             check_correct_host()
             # Run CCAM simulation
             print("Run CCAM")
+            start_mesonest_prefetch()
             run_model()
 
         if d['postprocess_test'] is True:
-            print("Post-process CCAM output")
-            post_process_output()
+            if (d['postprocs'] > 0) and (d['simulation_test'] is True):
+                print("Post-process CCAM output in the background")
+                start_post_process()
+            elif (d['postmode'] == "backlog") and (d['dmode'] == "postprocess"):
+                print("Post-process CCAM output backlog")
+                refresh_dir_index(['{wdir}'] + ['{hdir}/'+dirname for dirname in output_dir_list])
+                post_process_backlog()
+            else:
+                print("Post-process CCAM output")
+                refresh_dir_index(['{wdir}'] + ['{hdir}/'+dirname for dirname in output_dir_list])
+                post_process_output()
 
         if d['timeloop_test'] is True:
-            print("Update simulation date and time")	
-            update_monthyear()
-            update_yearqm()
-
-    print("----------------------------------------")
-    print("Simulation loop completed")
-
-    # Check if restart is required
-    print("Update simulation restart status")
-    restart_flag()
+            print("Update simulation date and time")
+            if (d['localdir'] != "none") and (d['simulation_test'] is True):
+                loglist = [os.path.abspath(dict2str(fname)) for fname in ['prnew.{kdates}.{name}', 'err.{iyr}']]
+                edate = d['iyr']*100 + d['imth']
+                wait_for_copy_back()
+                update_monthyear()
+                start_copy_back(loglist, postproc['future'], edate)
+            else:
+                update_monthyear()
+                update_yearqm()
 
-    print("Script completed sucessfully")
+    def start_process(self):
+        "Start the run in a separate process"
+        proc = multiprocessing.Process(target=self.run)
+        proc.start()
+        return proc
 
 
 #===============================================================================
@@ -276,6 +477,11 @@ def check_inargs():
     d['iyr'] = d['iys']
     d['imth'] = d['ims']
 
+    # ranks reserved for post-processing while the model runs
+    if d['postprocs'] > 0:
+        if d['postprocs'] >= d['nproc']:
+            raise ValueError("postprocs must be smaller than nproc")
+
 
 def create_directories():
     "Create output directories and go to working directory"
@@ -336,12 +542,18 @@ def create_directories():
                 os.mkdir(dirname)
 
     if d['dmode'] == "postprocess":
-        run_cmdline('rm -f {hdir}/restart5.qm')    
+        remove_files('{hdir}/restart5.qm')    
         dirname = dict2str('{hdir}/OUTPUT')
         if not os.path.isdir(dirname):
             raise ValueError("dmode=postprocess requires existing data in OUTPUT directory")
     else:
-        run_cmdline('rm -f {hdir}/restart.qm')    
+        remove_files('{hdir}/restart.qm')    
+        if d['localdir'] != "none":
+            # run in node-local storage and copy results back to hdir
+            d['sharedwdir'] = os.path.abspath(dict2str('{wdir}'))
+            d['wdir'] = dict2str('{localdir}/ccam.{name}')
+            print("-> Using local working directory ",d['wdir'])
+            os.makedirs(d['wdir'], exist_ok=True)
         dirname = dict2str('{wdir}')
 
     # change to working or OUTPUT directory, depending on dmode
@@ -373,10 +585,27 @@ def restart_flag():
 # Timeloop functions
 #===============================================================================
 
-def get_datetime():
+def get_datetime(readqm=True):
     "Determine relevant dates and timesteps for running model"
 
     # Load year.qm with current simulation year:
+    if readqm is True:
+        read_yearqm()
+
+    # Abort run at finish year
+    sdate = d['iyr']*10000 + d['imth']*100 + d['iday']
+    edate = d['iye']*10000 + d['ime']*100 + d['ide']
+    if (sdate>edate) and (d['simulation_test'] is True):
+        print("CCAM simulation already completed. Delete year.qm to restart.")
+        write2file(d['hdir']+'/restart.qm', "Complete", mode='w+')
+        sys.exit(0)
+
+    set_month_dates()
+
+
+def read_yearqm():
+    "Read the current simulation date from year.qm"
+
     fname = dict2str('{hdir}/year.qm')
     if os.path.exists(fname):
         yyyydd = open(fname).read()
@@ -393,14 +622,9 @@ def get_datetime():
         d['imth'] = d['ims']
         d['iday'] = d['ids']
 
-    # Abort run at finish year
-    sdate = d['iyr']*10000 + d['imth']*100 + d['iday']
-    edate = d['iye']*10000 + d['ime']*100 + d['ide']
-    if (sdate>edate) and (d['simulation_test'] is True):
-        print("CCAM simulation already completed. Delete year.qm to restart.")
-        write2file(d['hdir']+'/restart.qm', "Complete", mode='w+')
-        sys.exit(0)
 
+def set_month_dates():
+    "Define dates derived from the current simulation month"
 
     # Calculate date of previous month
     iyr = d['iyr']
@@ -435,6 +659,8 @@ def get_datetime():
     d['ddyear'] = int(int(d['rad_year']/10)*10)
     d['deyear'] = int(d['ddyear'] + 9)
 
+    d['ofile'] = dict2str('{name}.{iyr}{imth_2digit}')
+
 
 def update_monthyear():
     # update counter for next simulation month and remove old files
@@ -462,13 +688,15 @@ def update_monthyear():
     if d['imth'] < 12:
         fname = dict2str('Rest{name}.{iyrlst}12.000000')
         if os.path.exists(fname):
-            run_cmdline('rm Rest{name}.{iyrlst}12.??????')
+            remove_files('Rest{name}.{iyrlst}12.??????', background=True)
 
     if d['imth'] > 12:
         fname = dict2str('Rest{name}.{iyr}12.000000')
         if os.path.exists(fname):
-            run_cmdline('tar cvf {hdir}/RESTART/Rest{name}.{iyr}12.tar Rest{name}.{iyr}12.??????')
-            run_cmdline('rm Rest{name}.{iyr}0?.?????? Rest{name}.{iyr}10.?????? Rest{name}.{iyr}11.??????')
+            create_tar('{hdir}/RESTART/Rest{name}.{iyr}12.tar', 'Rest{name}.{iyr}12.??????')
+            remove_files('Rest{name}.{iyr}0?.??????', background=True)
+            remove_files('Rest{name}.{iyr}10.??????', background=True)
+            remove_files('Rest{name}.{iyr}11.??????', background=True)
             #run_cmdline('rm {name}*{iyr}??')
             #run_cmdline('rm {name}*{iyr}??.nc')
         d['imth'] = 1
@@ -482,6 +710,99 @@ def update_yearqm():
     write2file(d['hdir']+'/year.qm', "{yyyymmdd}", mode='w+')
 
 
+# With --localdir the run uses a node-local working directory.  Output files
+# for hdir are moved to {wdir}/copyback and copied to hdir in the background
+# while the next month runs, together with a tar file of the restart in
+# {hdir}/RESTART.  year.qm is only updated once the copies are verified, so
+# a job that is killed during the copy repeats the month from the previous
+# restart tar.  The main loop does not read year.qm again after the first
+# month (see CCAMRun.run).
+copyback = {'future': None}
+
+def copyback_dir(dest):
+    "Return dest, or the local directory of files waiting to be copied to dest"
+
+    if (d.get('localdir', "none") == "none") or (d['simulation_test'] is False):
+        return dest
+    rel = os.path.relpath(dict2str(dest), dict2str('{hdir}'))
+    cdir = os.path.join(dict2str('{wdir}'), 'copyback', rel)
+    os.makedirs(cdir, exist_ok=True)
+    return cdir
+
+
+def start_copy_back(loglist, after=None, edate=None):
+    "Start copying the completed month to hdir and then update year.qm"
+
+    wait_for_copy_back()
+    settings = dict(d.current())
+    copyback['future'] = launch_task(copy_back_month, settings, loglist, after, edate)
+
+
+def wait_for_copy_back():
+    "Wait for the copy of the previous month to hdir"
+
+    future = copyback['future']
+    if future is None:
+        return
+    copyback['future'] = None
+    wait_tasks([future])
+
+
+def copy_back_month(settings, loglist, after=None, edate=None):
+    "Copy output and restart files to hdir, and update year.qm"
+
+    # the month is complete once its background post-processing has finished
+    if after is not None:
+        wait_tasks([after])
+
+    with d.using(settings):
+        for fname in loglist:
+            if os.path.exists(fname):
+                copy_file_verified(fname, os.path.join(d['sharedwdir'], os.path.basename(fname)))
+        # the yearly restart tar is written to hdir by update_monthyear
+        tname = dict2str('{hdir}/RESTART/{restfile}.tar')
+        if os.path.exists(dict2str('{wdir}/{restfile}.000000')) and not os.path.exists(tname):
+            create_tar(os.path.join(copyback_dir('{hdir}/RESTART'), d['restfile']+'.tar'),
+                       os.path.join(d['wdir'], d['restfile']+'.??????'))
+        # tar files that are still being written end with .tmp
+        cdir = dict2str('{wdir}/copyback')
+        for dirpath, _, names in os.walk(cdir):
+            for name in sorted(names):
+                if name.endswith('.tmp'):
+                    continue
+                fname = os.path.join(dirpath, name)
+                newname = os.path.join(dict2str('{hdir}'), os.path.relpath(fname, cdir))
+                copy_file_verified(fname, newname)
+                remove_file(fname)
+        # post-processed output of the months up to edate is now in hdir
+        if (edate is not None) and (d['postprocess_test'] is True):
+            record_post_index_upto(edate)
+        update_yearqm()
+        # the restart of the previous month is no longer needed, except for
+        # the yearly restart
+        if d['imthlst'] != 12:
+            remove_files('{hdir}/RESTART/Rest{name}.{iyrlst}{imthlst_2digit}.tar')
+
+
+def copy_file_verified(fname, newname):
+    "Copy a file and check the content of the copy before it replaces newname"
+
+    os.makedirs(os.path.dirname(newname), exist_ok=True)
+    shutil.copyfile(fname, newname+'.tmp')
+    digest = []
+    for name in [fname, newname+'.tmp']:
+        sha = hashlib.sha1()
+        with open(name, 'rb') as ifile:
+            for block in iter(lambda: ifile.read(1048576), b''):
+                sha.update(block)
+        digest.append(sha.hexdigest())
+    if digest[0] != digest[1]:
+        remove_file(newname+'.tmp')
+        raise ValueError("Verification failed for copy of "+fname+" to "+newname)
+    os.replace(newname+'.tmp', newname)
+    update_dir_index(newname, True)
+
+
 #===============================================================================
 # Preprocess
 #===============================================================================
@@ -539,11 +860,68 @@ def check_surface_files():
     if d['aero'] == "prognostic":
         d['sulffile'] = dict2str('aero{domain}.{iyr}.{imth_2digit}')
 
-    # Check custom option
+    # Check surface products against their recorded inputs
+    manifest = read_surface_manifest()
+    if manifest is not None:
+        update_surface_products(manifest)
+    elif check_custom_land() is True:
+        print("Create surface data")
+        run_cable_all()
+    else:
+        # surface data created before the manifest was introduced
+        write_surface_manifest(calc_surface_product_keys())
+
+    for fname in ['topout', 'bath', 'casa']:
+        filename = dict2str('{vegin}/'+fname+'{domain}')
+        if not file_exists(filename):
+            print("Create surface data")
+            run_cable_all()
+
+    wait_for_landuse_lookahead()
+
+    graph = []
+    testfail = check_landuse_files(landuse_file_list())
+    if testfail is True:
+        print("Update land-surface data")
+        if (d['vegmode'] == "all") and landuse_varies():
+            graph.extend(landuse_year_tasks())
+        else:
+            graph.append(graph_task('igbpveg', functools.partial(run_cable_land_year, dict(d.current())),
+                                    threads=d['nnode']))
+
+    # check aerosols
+    if d['aero'] == "prognostic":
+        fname = dict2str('{vegin}/{sulffile}')
+        if file_exists(fname) and not check_aero_file():
+            print("Remove outdated aerosol data for {0}".format(d['sulffile']))
+            remove_file(fname)
+        if not file_exists(fname):
+            print("Update aerosol data")	
+            if d['aeromode'] == "monthly":
+                graph.append(graph_task('aeroemiss', functools.partial(run_aerosol_month, dict(d.current())),
+                                    threads=d['nnode']))
+            else:
+                graph.extend(aerosol_month_tasks())
+
+    # land-use and aerosols both use {vegin}/topout and can run concurrently.
+    # Each task has its own copy of the settings (e.g., rcplabel differs for
+    # land-use and aerosols) and its own working directory.
+    run_task_graph(graph)
+    if len(graph) > 0:
+        update_custom_land()
+
+    # the next year is needed after the December simulation
+    if (d['vegmode'] == "lookahead") and (d['imth'] == 12) and (d['simulation_test'] is True) and landuse_varies():
+        start_landuse_lookahead()
+
+
+def check_custom_land():
+    "Check if custom.qm matches the current surface file configuration"
+
     cfname = dict2str('{vegin}/custom.qm')
-    if not os.path.exists(cfname):
+    if not file_exists(cfname):
         cfname = dict2str('{hdir}/custom.qm')
-    if not os.path.exists(cfname):
+    if not file_exists(cfname):
         cfname = dict2str('{wdir}/custom.qm')
 
     testfail = False    
@@ -580,37 +958,7 @@ def check_surface_files():
             print("WARN: sib changed in custom.qm - Need to rebuild vegetation")
             testfail = True
         filename.close()
-    if testfail is True:
-        print("Create surface data")
-        run_cable_all()
-
-    for fname in ['topout', 'bath', 'casa']:
-        filename = dict2str('{vegin}/'+fname+'{domain}')
-        if not os.path.exists(filename):
-            print("Create surface data")
-            run_cable_all()
-
-    testfail = False
-    for mon in range(1, 13):
-        if (d['cmip']=="cmip5") or (d['sib']=="cable_const") or (d['sib']=='cable_modis2020_const'):
-            fname = dict2str('{vegin}/veg{domain}.'+mon_2digit(mon))
-        else:
-            fname = dict2str('{vegin}/veg{domain}.{iyr}.'+mon_2digit(mon))
-        if not os.path.exists(fname):
-            testfail = True
-        if check_correct_landuse(fname):
-            #print("WARN: Cannot find valid CABLE data for ",fname)
-            testfail = True
-    if testfail is True:
-        print("Update land-surface data")
-        run_cable_land()
-
-    # check aerosols
-    if d['aero'] == "prognostic":
-        fname = dict2str('{vegin}/{sulffile}')
-        if not os.path.exists(fname):
-            print("Update aerosol data")	
-            run_aerosol()
+    return testfail
 
 
 def run_cable_all():
@@ -618,68 +966,345 @@ def run_cable_all():
 
     # Update all topography, landtype, bathymetry and carbon input files
 
-    run_cmdline('rm -f {vegin}/topo*')
-    run_cmdline('rm -f {vegin}/veg*')    
-    run_cmdline('rm -f {vegin}/bath*')    
-    run_cmdline('rm -f {vegin}/casa*')    
-    run_cmdline('rm -f {vegin}/aero*')  # delete aerosols due to cmip/rcp change  
-    run_topo()
-    run_land()
-    run_ocean()
-    run_carbon()
-    run_cmdline('mv -f topout{domain} {vegin}')
-    run_cmdline('mv -f veg{domain}* {vegin}')
-    run_cmdline('mv -f bath{domain} {vegin}')
-    run_cmdline('mv -f casa{domain} {vegin}')
+    remove_files('{vegin}/topo*')
+    remove_files('{vegin}/veg*')
+    remove_files('{vegin}/bath*')
+    remove_files('{vegin}/casa*')
+    remove_files('{vegin}/aero*')  # delete aerosols due to cmip/rcp change
+    set_change_landuse()
+    with surface_cache_entry('land', [top_template(), igbpveg_namelist(), ocnbath_template(), casafield_input],
+                             ['terread', 'igbpveg', 'ocnbath', 'casafield']) as entry:
+        if not fetch_surface_cache(entry, '.'):
+            # bathymetry and carbon only depend on the topography from run_land
+            run_task_graph([graph_task('terread', run_topo_raw),
+                            graph_task('igbpveg', run_land, ['terread'], d['nnode']),
+                            graph_task('ocnbath', run_ocean, ['igbpveg'], d['nnode']),
+                            graph_task('casafield', run_carbon, ['igbpveg'])])
+            store_surface_cache(entry, ['toporaw{domain}', 'topout{domain}', 'veg{domain}*', 'bath{domain}', 'casa{domain}'])
+    if file_exists(dict2str('toporaw{domain}')):
+        move_files('toporaw{domain}', '{vegin}')
+    move_files('topout{domain}', '{vegin}')
+    move_files('veg{domain}*', '{vegin}')
+    move_files('bath{domain}', '{vegin}')
+    move_files('casa{domain}', '{vegin}')
     update_custom_land()
+    write_surface_manifest(calc_surface_product_keys())
 
 
-def run_cable_land():
+def run_topo_raw():
+    "Run terread and keep its topography as toporaw"
+
+    run_topo()
+    # igbpveg replaces topout
+    copy_file('topout{domain}', 'toporaw{domain}')
+
+
+def run_cable_land(cwd='.'):
     "Generate topography and land-use files for CCAM"
 
     # update only landtype files
 
-    run_cmdline("ln -s {vegin}/topout{domain} .")
-    run_land()
-    run_cmdline('rm -f topout{domain}')
-    run_cmdline('mv -f veg{domain}* {vegin}')
+    link_files('{vegin}/topout{domain}', cwd)
+    set_change_landuse()
+    with surface_cache_entry('veg', [igbpveg_namelist()], ['igbpveg'], ['{vegin}/topout{domain}']) as entry:
+        if not fetch_surface_cache(entry, cwd):
+            run_land(cwd)
+            store_surface_cache(entry, [os.path.join(cwd, 'veg{domain}*')])
+    remove_files(os.path.join(cwd, 'topout{domain}'))
+    move_files(os.path.join(cwd, 'veg{domain}*'), '{vegin}')
     update_custom_land()
 
 
+def landuse_varies():
+    "Return True if the land-use files change with the year"
+
+    return not ((d['cmip']=="cmip5") or (d['sib']=="cable_const") or (d['sib']=="cable_modis2020_const"))
+
+
+def landuse_file_list():
+    "Return the land-use files for the current year"
+
+    flist = []
+    for mon in range(1, 13):
+        if landuse_varies():
+            fname = dict2str('{vegin}/veg{domain}.{iyr}.'+mon_2digit(mon))
+        else:
+            fname = dict2str('{vegin}/veg{domain}.'+mon_2digit(mon))
+        flist.append(fname)
+    return flist
+
+
+def landuse_year_settings(iyr):
+    "Return a copy of the current settings for the land-use of year iyr"
+
+    settings = dict(d.current())
+    settings.update({'iyr': iyr})
+    return settings
+
+
+def landuse_year_tasks():
+    "Define igbpveg tasks for the current and all remaining years of the simulation"
+
+    # each year is built in its own working directory, so the years can
+    # run concurrently
+    graph = []
+    for iyr in range(d['iyr'], d['iye']+1):
+        settings = landuse_year_settings(iyr)
+        with d.using(settings):
+            if check_landuse_files(landuse_file_list()) is True:
+                graph.append(graph_task(dict2str('igbpveg.{iyr}'), functools.partial(run_cable_land_year, settings),
+                                        threads=d['nnode']))
+    return graph
+
+
+def run_cable_land_year(settings):
+    "Run igbpveg for one year in its own working directory"
+
+    with d.using(settings):
+        cwd = dict2str('{wdir}/veg.{iyr}')
+        os.makedirs(cwd, exist_ok=True)
+        run_cable_land(cwd)
+        shutil.rmtree(cwd)
+
+
+# The land-use for the next year is built in the background while the
+# December simulation runs (vegmode=lookahead).  This needs cores that are
+# not used by the model (e.g., nproc smaller than the allocation).
+lookahead = {'veg': None}
+
+def start_landuse_lookahead():
+    "Start building the land-use files for the next year in the background"
+
+    if (d['iyr'] >= d['iye']) or (lookahead['veg'] is not None):
+        return
+    settings = landuse_year_settings(d['iyr']+1)
+    with d.using(settings):
+        if check_landuse_files(landuse_file_list()) is False:
+            return
+        print(dict2str("Start land-use data for {iyr} in the background"))
+        lookahead['veg'] = launch_task(run_cable_land_year, settings)
+
+
+def wait_for_landuse_lookahead():
+    "Wait for the background land-use files of the next year"
+
+    future = lookahead['veg']
+    if future is None:
+        return
+    lookahead['veg'] = None
+    try:
+        future.result()
+    except Exception as err:
+        # the files are checked and rebuilt by check_surface_files
+        print("WARN: Background land-use update failed: ", err)
+
+
+custom_lock = threading.Lock()
+
 def update_custom_land():
     "Update custom.qm with current preprocess files"
 
     # record surface file configurations
     # this information is used to determine if surface files need to be recalculated
 
-    filename = open(dict2str('{vegin}/custom.qm'), 'w+')
-    filename.write(dict2str('{uclemparm}\n'))
-    filename.write(dict2str('{cableparm}\n'))
-    filename.write(dict2str('{soilparm}\n'))
-    filename.write(dict2str('{vegindex}\n'))
-    filename.write(dict2str('{uservegfile}\n'))
-    filename.write(dict2str('{userlaifile}\n'))
-    filename.write(dict2str('{cmip}\n'))
-    filename.write(dict2str('{rcp}\n'))
-    filename.write(dict2str('{sib}\n'))    
-    filename.close()
+    # land-use tasks for different years can finish at the same time
+    with custom_lock:
+        filename = open(dict2str('{vegin}/custom.qm'), 'w+')
+        filename.write(dict2str('{uclemparm}\n'))
+        filename.write(dict2str('{cableparm}\n'))
+        filename.write(dict2str('{soilparm}\n'))
+        filename.write(dict2str('{vegindex}\n'))
+        filename.write(dict2str('{uservegfile}\n'))
+        filename.write(dict2str('{userlaifile}\n'))
+        filename.write(dict2str('{cmip}\n'))
+        filename.write(dict2str('{rcp}\n'))
+        filename.write(dict2str('{sib}\n'))    
+        filename.close()
+    update_dir_index(dict2str('{vegin}/custom.qm'), True)
+
+
+def read_surface_manifest():
+    "Read the inputs of each surface product from {vegin}/manifest.json"
+
+    fname = dict2str('{vegin}/manifest.json')
+    if not file_exists(fname):
+        return None
+    try:
+        with open(fname) as mfile:
+            return json.load(mfile)
+    except (OSError, ValueError):
+        print("WARN: Unable to read ",fname)
+        return None
+
+
+def write_surface_manifest(manifest):
+    "Write the inputs of each surface product to {vegin}/manifest.json"
+
+    fname = dict2str('{vegin}/manifest.json')
+    with open(fname+'.tmp', 'w') as mfile:
+        json.dump(manifest, mfile, indent=1, sort_keys=True)
+    os.replace(fname+'.tmp', fname)
+    update_dir_index(fname, True)
+
+
+def calc_surface_product_keys():
+    "Return the current input keys of all surface products"
+
+    set_change_landuse()
+    return {'topo': calc_topo_key(), 'land': calc_land_key(), 'bath': calc_bath_key(),
+            'casa': calc_casa_key(), 'aero': calc_aero_key()}
+
+
+# Surface products and their inputs:
+#   topo (toporaw) - terread namelist
+#   land (topout and veg) - toporaw, igbpveg namelist and CABLE parameters
+#   bath - topout and ocnbath namelist
+#   casa - topout and casafield dataset
+#   aero - topout, cmip and rcp (and the inventories of each month)
+# igbpveg rewrites topout, so the downstream products depend on its content.
+# Datasets are keyed on their path only and executables are not included,
+# so that rebuilding a tool or touching a dataset does not change the lower
+# boundary conditions part way through a simulation.
+
+def calc_topo_key():
+    "Return the input key of the terread topography"
+
+    return calc_surface_key('topo', [top_template()], ['terread'], stats=False)
+
+
+def calc_land_key():
+    "Return the input key of the igbpveg topography and land-use"
+
+    # the year only selects the land-use of run_cable_land
+    text = '\n'.join([line for line in igbpveg_namelist().split('\n')
+                      if ('year=' not in line) and ('change_landuse=' not in line)])
+    return calc_surface_key('land', [text, '{cmip} {rcp}'], ['igbpveg'], ['{vegin}/toporaw{domain}'], stats=False)
+
+
+def calc_bath_key():
+    "Return the input key of the bathymetry"
+
+    return calc_surface_key('bath', [ocnbath_template()], ['ocnbath'], ['{vegin}/topout{domain}'], stats=False)
+
+
+def calc_casa_key():
+    "Return the input key of the carbon data"
+
+    return calc_surface_key('casa', [casafield_input], ['casafield'], ['{vegin}/topout{domain}'], stats=False)
+
+
+def calc_aero_key():
+    "Return the input key of the aerosol emissions"
+
+    # the inventory and forcing files of each month are checked by check_aero_file
+    return calc_surface_key('aero', ['{cmip} {rcp}'], ['aeroemiss'], ['{vegin}/topout{domain}'], stats=False)
+
+
+def update_surface_products(manifest):
+    "Rebuild the surface products whose inputs have changed"
+
+    set_change_landuse()
+    testfail = False
+
+    key = calc_topo_key()
+    if manifest.get('topo') != key:
+        print("Update topography")
+        run_topo()
+        move_files('topout{domain}', '{vegin}/toporaw{domain}')
+        manifest['topo'] = key
+        testfail = True
+
+    key = calc_land_key()
+    if manifest.get('land') != key:
+        print("Update land-surface data and topography")
+        if not file_exists(dict2str('{vegin}/toporaw{domain}')):
+            # surface data created before toporaw was kept
+            run_topo()
+            move_files('topout{domain}', '{vegin}/toporaw{domain}')
+            manifest['topo'] = calc_topo_key()
+            key = calc_land_key()
+        remove_files('{vegin}/veg*')
+        copy_file('{vegin}/toporaw{domain}', 'topout{domain}')
+        run_land()
+        move_files('topout{domain}', '{vegin}')
+        move_files('veg{domain}*', '{vegin}')
+        manifest['land'] = key
+        testfail = True
+
+    # bathymetry and carbon use topout and can run concurrently
+    graph = []
+    key = calc_bath_key()
+    if manifest.get('bath') != key:
+        print("Update bathymetry")
+        graph.append(graph_task('ocnbath', run_ocean, threads=d['nnode']))
+        manifest['bath'] = key
+    key = calc_casa_key()
+    if manifest.get('casa') != key:
+        print("Update carbon data")
+        graph.append(graph_task('casafield', run_carbon))
+        manifest['casa'] = key
+    if len(graph) > 0:
+        link_files('{vegin}/topout{domain}', '.')
+        run_task_graph(graph)
+        remove_files('topout{domain}')
+        for task in graph:
+            if task['func'] is run_ocean:
+                move_files('bath{domain}', '{vegin}')
+            if task['func'] is run_carbon:
+                move_files('casa{domain}', '{vegin}')
+        testfail = True
+
+    # aerosols are created for each month as required
+    key = calc_aero_key()
+    if manifest.get('aero') != key:
+        print("Remove outdated aerosol data")
+        remove_files('{vegin}/aero*')
+        manifest['aero'] = key
+        testfail = True
+
+    if testfail is True:
+        update_custom_land()
+        write_surface_manifest(manifest)
 
 
 def run_topo():
     "Run terread for topography"
 
     print("-> Generating topography file")
-    write2file('top.nml', top_template(), mode='w+')
+    write2file('top.nml', top_template(), mode='w+', stage=True)
     if d['machinetype'] == "srun":
-        run_cmdline('srun -n 1 {terread} < top.nml > terread.log')
+        run_cmdline('srun -n 1 {terread} < top.nml > terread.log', check=False)
     else:
-        run_cmdline('{terread} < top.nml > terread.log')
+        run_cmdline('{terread} < top.nml > terread.log', check=False)
     check_msg_in_log("terread","terread.log","terread completed successfully")
 
 
-def run_land():
+def run_land(cwd='.'):
     "Run landuse program"
 
+    set_change_landuse()
+
+    if d['change_landuse'] == "":
+        print("-> Generating CABLE land-use data (constant)")
+    else:
+        print("-> Generating CABLE land-use data (varying)")
+
+    write2file(os.path.join(cwd, 'igbpveg.nml'), igbpveg_namelist(), mode='w+', stage=True)
+        
+    # Run IGBPVEG
+    if d['machinetype'] == "srun":
+        run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m srun -n 1 -c {nnode} {igbpveg} -s 5000 < igbpveg.nml > igbpveg.log', check=False, cwd=cwd)
+    else:
+        run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m {igbpveg} -s 5000 < igbpveg.nml > igbpveg.log', check=False, cwd=cwd)
+
+    # Check for errors
+    check_msg_in_log("igbpveg",os.path.join(cwd, "igbpveg.log"),"igbpveg completed successfully")
+    move_files(os.path.join(cwd, 'topsib{domain}'), os.path.join(cwd, 'topout{domain}'))
+
+
+def set_change_landuse():
+    "Define the land-use change dataset for igbpveg"
+
     #default will disable change_landuse
     d['change_landuse'] = ""
 
@@ -704,48 +1329,40 @@ def run_land():
                     raise ValueError(dict2str("Invalid choice for rcp"))
                 d['change_landuse'] = dict2str('{stdat}/{cmip}/{rcp}/multiple-states_input4MIPs_landState_ScenarioMIP_UofMD-{rcplabel}-{rcp}-2-1-f_gn_2015-2100.nc')
 
-    if d['change_landuse'] == "":
-        print("-> Generating CABLE land-use data (constant)")
-    else:
-        print("-> Generating CABLE land-use data (varying)")
+
+def igbpveg_namelist():
+    "Return the igbpveg.nml template for the selected land-use dataset"
 
     # use MODIS2020 dataset
     if (d['sib']=="cable_modis2020") or (d['sib']=="cable_sli_modis2020") or (d['sib']=="cable_modis2020_const"):
-        write2file('igbpveg.nml', igbpveg_template2(), mode='w+')
-    else:
-        write2file('igbpveg.nml', igbpveg_template(), mode='w+')
-        
-    # Run IGBPVEG
-    if d['machinetype'] == "srun":
-        run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m srun -n 1 -c {nnode} {igbpveg} -s 5000 < igbpveg.nml > igbpveg.log')
-    else:
-        run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m {igbpveg} -s 5000 < igbpveg.nml > igbpveg.log')
-
-    # Check for errors
-    check_msg_in_log("igbpveg","igbpveg.log","igbpveg completed successfully")
-    run_cmdline('mv -f topsib{domain} topout{domain}')
+        return igbpveg_template2()
+    return igbpveg_template()
 
 
 def run_ocean():
     "Run ocnbath for ocean bathymetry and rivers"
 
     print("-> Processing bathymetry data")
-    write2file('ocnbath.nml', ocnbath_template(), mode='w+')
+    write2file('ocnbath.nml', ocnbath_template(), mode='w+', stage=True)
     if d['machinetype'] == "srun":
-        run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m srun -n 1 -c {nnode} {ocnbath} -s 5000 < ocnbath.nml > ocnbath.log')
+        run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m srun -n 1 -c {nnode} {ocnbath} -s 5000 < ocnbath.nml > ocnbath.log', check=False)
     else:
-        run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m {ocnbath} -s 5000 < ocnbath.nml > ocnbath.log')
+        run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m {ocnbath} -s 5000 < ocnbath.nml > ocnbath.log', check=False)
     check_msg_in_log("ocnbath","ocnbath.log","ocnbath completed successfully")
 
 
+# casafield input dataset (used for the shared surface cache key)
+casafield_input = '{insdir}/vegin/casaNP_gridinfo_1dx1d.nc'
+
 def run_carbon():
     "Run casafield for carbon cycle emissions"
 
     print("-> Processing CASA data")
+    casafile = stage_input_file(dict2str(casafield_input))
     if d['machinetype'] == "srun":
-        run_cmdline('srun -n 1 {casafield} -t topout{domain} -i {insdir}/vegin/casaNP_gridinfo_1dx1d.nc -o casa{domain} > casafield.log')
+        run_cmdline('srun -n 1 {casafield} -t topout{domain} -i '+casafile+' -o casa{domain} > casafield.log', check=False)
     else:
-        run_cmdline('{casafield} -t topout{domain} -i {insdir}/vegin/casaNP_gridinfo_1dx1d.nc -o casa{domain} > casafield.log')
+        run_cmdline('{casafield} -t topout{domain} -i '+casafile+' -o casa{domain} > casafield.log', check=False)
     check_msg_in_log("casafield","casafield.log","casafield completed successfully")
 
 
@@ -754,125 +1371,261 @@ def run_aerosol():
     
     # Update only aerosol files
     
-    create_aeroemiss_file()
+    key = create_aeroemiss_file()
     if d['aero'] == "prognostic":    
-        run_cmdline('mv -f {sulffile} {vegin}')
+        move_files('{sulffile}', '{vegin}')
+        record_aero_file(key)
         update_custom_land()
 
 
-def create_aeroemiss_file():
-    "Prepare aerosol files"
+def aerosol_month_tasks():
+    "Define aeroemiss tasks for every missing month of the selected years"
+
+    # aeromode=year creates the current year and aeromode=all creates all
+    # remaining years of the simulation
+    if d['aeromode'] == "year":
+        yearlist = [d['iyr']]
+    else:
+        yearlist = range(d['iyr'], d['iye']+1)
+    # months with identical inputs wait for the first one and then link to it
+    graph = []
+    first = {}
+    for iyr in yearlist:
+        # the historical period check reports later years when they are reached
+        if (d['rcp'] == "historic") and (iyr > d['iyr']):
+            if ((d['cmip'] == "cmip5") and (iyr >= 2005)) or ((d['cmip'] == "cmip6") and (iyr >= 2015)):
+                break
+        for imth in range(1, 13):
+            settings = dict(d.current())
+            settings.update({'iyr': iyr, 'imth': imth, 'iday': 1})
+            with d.using(settings):
+                set_month_dates()
+                d['sulffile'] = dict2str('aero{domain}.{iyr}.{imth_2digit}')
+                fname = dict2str('{vegin}/{sulffile}')
+                if file_exists(fname) and not check_aero_file():
+                    remove_file(fname)
+                if not file_exists(fname):
+                    name = dict2str('aeroemiss.{iyr}{imth_2digit}')
+                    d.update(get_forcing_files())
+                    key = calc_aero_file_key()
+                    after = []
+                    if key in first:
+                        after = [first[key]]
+                    else:
+                        first[key] = name
+                    graph.append(graph_task(name, functools.partial(run_aerosol_month, settings),
+                                            after, d['nnode']))
+    return graph
+
+
+def run_aerosol_month(settings):
+    "Run aeroemiss for one month in its own working directory"
+
+    with d.using(settings):
+        cwd = dict2str('{wdir}/aero.{iyr}{imth_2digit}')
+        os.makedirs(cwd, exist_ok=True)
+        key = create_aeroemiss_file(cwd)
+        move_files(os.path.join(cwd, d['sulffile']), '{vegin}')
+        record_aero_file(key)
+        shutil.rmtree(cwd)
+
+
+def create_aeroemiss_file(cwd='.'):
+    "Prepare aerosol files and return the key of their inputs"
 
     if d['aero'] == "prognostic":
 
-        print("-> Create aerosol emissions")
-
-        if d['cmip'] == "cmip5":
-            if d['rcp'] == "historic" or d['rad_year'] < 2010:
-                aero = {'so2_anth': get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_SO2_anthropogenic_{ddyear}*.nc'),
-                        'so2_ship': get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_SO2_ships_{ddyear}*.nc'),
-                        'so2_biom': get_fpath('{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_SO2_decadalmonthlymean{ddyear}*.nc'),
-                        'bc_anth':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_BC_anthropogenic_{ddyear}*.nc'),
-                        'bc_ship':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_BC_ships_{ddyear}*.nc'),
-                        'bc_biom':  get_fpath('{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_BC_decadalmonthlymean{ddyear}*.nc'),
-                        'oc_anth':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_OC_anthropogenic_{ddyear}*.nc'),
-                        'oc_ship':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_OC_ships_{ddyear}*.nc'),
-                        'oc_biom':  get_fpath('{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_OC_decadalmonthlymean{ddyear}*.nc')}
-            elif d['rad_year'] < 2100:
-                aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_anthropogenic_{ddyear}*.nc'),
-                        'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_ships_{ddyear}*.nc'),
-                        'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_biomassburning_{ddyear}*.nc'),
-                        'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_anthropogenic_{ddyear}*.nc'),
-                        'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_ships_{ddyear}*.nc'),
-                        'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_biomassburning_{ddyear}*.nc'),
-                        'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_anthropogenic_{ddyear}*.nc'),
-                        'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_ships_{ddyear}*.nc'),
-                        'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_biomassburning_{ddyear}*.nc')}
-            else:
-                aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_anthropogenic_2090*.nc'),
-                        'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_ships_2090*.nc'),
-                        'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_biomassburning_2090*.nc'),
-                        'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_anthropogenic_2090*.nc'),
-                        'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_ships_2090*.nc'),
-                        'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_biomassburning_2090*.nc'),
-                        'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_anthropogenic_2090*.nc'),
-                        'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_ships_2090*.nc'),
-                        'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_biomassburning_2090*.nc')}
-        elif d['cmip'] == "cmip6":
-            if d['rcp'] == "historic" or d['rad_year'] < 2015:
-                aero = {'so2_anth': get_fpath('{stdat}/{cmip}/cmip/SO2-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
-                        'so2_ship': get_fpath('{stdat}/{cmip}/cmip/SO2-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
-                        'so2_biom': get_fpath('{stdat}/{cmip}/cmip/SO2-em-openburning-share_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
-                        'bc_anth':  get_fpath('{stdat}/{cmip}/cmip/BC-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
-                        'bc_ship':  get_fpath('{stdat}/{cmip}/cmip/BC-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
-                        'bc_biom':  get_fpath('{stdat}/{cmip}/cmip/BC-em-openburning-share_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
-                        'oc_anth':  get_fpath('{stdat}/{cmip}/cmip/OC-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
-                        'oc_ship':  get_fpath('{stdat}/{cmip}/cmip/OC-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
-                        'oc_biom':  get_fpath('{stdat}/{cmip}/cmip/OC-em-openburning-share_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc')}
-            else:
-                if d['rcp'] == "ssp126":
-                    d['rcplabel'] = "IMAGE"
-                elif d['rcp'] == "ssp245":
-                    d['rcplabel'] = "MESSAGE-GLOBIOM"
-                elif d['rcp'] == "ssp370":
-                    d['rcplabel'] = "AIM"
-                elif d['rcp'] == "ssp460":
-                    d['rcplabel'] = "GCAM4"
-                elif d['rcp'] == "ssp585":
-                    d['rcplabel'] = "REMIND-MAGPIE"
-                else:
-                    raise ValueError(dict2str("Invalid choice for rcp"))
+        d.update(get_forcing_files())
+
+        # link to an existing file with the same inputs (e.g., same decade)
+        key = calc_aero_file_key()
+        fname = find_aero_file(key)
+        if fname is not None:
+            print(dict2str("-> Link aerosol emissions for {iyr}{imth_2digit} to "),fname)
+            copy_file(fname, os.path.join(cwd, d['sulffile']))
+            return key
+
+        print(dict2str("-> Create aerosol emissions for {iyr}{imth_2digit}"))
 
-                if d['rad_year'] < 2020:
-                    aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
-                            'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
-                            'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
-                            'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
-                            'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
-                            'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
-                            'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
-                            'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
-                            'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc')}
-                elif d['rad_year'] < 2100:
-                    aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
-                            'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
-                            'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
-                            'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
-                            'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
-                            'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
-                            'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
-                            'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
-                            'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc')}
+        write2file(os.path.join(cwd, 'aeroemiss.nml'), aeroemiss_template(), mode='w+', stage=True)
+
+        # Create new sulffile
+        with surface_cache_entry('aero', [aeroemiss_template()], ['aeroemiss'], ['{vegin}/topout{domain}']) as entry:
+            if not fetch_surface_cache(entry, cwd):
+                if d['machinetype'] == "srun":
+                    run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m srun -n 1 -c {nnode} {aeroemiss} -o {sulffile} < aeroemiss.nml > aero.log', check=False, cwd=cwd)
                 else:
-                    aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
-                            'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
-                            'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
-                            'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
-                            'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
-                            'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
-                            'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
-                            'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
-                            'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc')}
-        else:
-            raise ValueError(dict2str("Invalid choice for cmip"))
+                    run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m {aeroemiss} -o {sulffile} < aeroemiss.nml > aero.log', check=False, cwd=cwd)
+                check_msg_in_log("aeroemiss",os.path.join(cwd, "aero.log"),"aeroemiss completed successfully")
+                store_surface_cache(entry, [os.path.join(cwd, d['sulffile'])])
+        return key
 
-        aero['volcano'] = dict2str('{stdat}/contineous_volc.nc')
-        aero['dmsfile'] = dict2str('{stdat}/dmsemiss.nc')
-        aero['dustfile'] = dict2str('{stdat}/ginoux.nc')
+    return None
 
-        for fpath in iter(aero.keys()):
-            check_file_exists(aero[fpath])
 
-        d.update(aero)
+# Aerosol files with identical inputs (inventories, month, topout, volcano,
+# dms and dust) are identical.  {vegin}/aerokeys.json maps the key of the
+# inputs to the first aerosol file created with them, and the name of each
+# aerosol file to the key of its inputs (see check_aero_file).
+aero_lock = threading.Lock()
 
-        write2file('aeroemiss.nml', aeroemiss_template(), mode='w+')
+def calc_aero_file_key():
+    "Return the key of the inputs of the current aerosol file"
 
-        # Create new sulffile
-        if d['machinetype'] == "srun":
-            run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m srun -n 1 -c {nnode} {aeroemiss} -o {sulffile} < aeroemiss.nml > aero.log')
+    return calc_surface_key('aero', [aeroemiss_template()], ['aeroemiss'], ['{vegin}/topout{domain}'], stats=False)
+
+
+def read_aero_keys():
+    "Read the aerosol input keys recorded in {vegin}/aerokeys.json"
+
+    fname = dict2str('{vegin}/aerokeys.json')
+    try:
+        with open(fname) as kfile:
+            return json.load(kfile)
+    except (OSError, ValueError):
+        return {}
+
+
+def find_aero_file(key):
+    "Return an existing aerosol file created from the same inputs, or None"
+
+    with aero_lock:
+        name = read_aero_keys().get(key)
+    if name is None:
+        return None
+    fname = dict2str('{vegin}/'+name)
+    if not os.path.exists(fname):
+        return None
+    return fname
+
+
+def record_aero_file(key):
+    "Record the inputs of the current aerosol file in {vegin}/aerokeys.json"
+
+    if key is None:
+        return
+    fname = dict2str('{vegin}/aerokeys.json')
+    with aero_lock:
+        keys = read_aero_keys()
+        if (key not in keys) or (keys.get(d['sulffile']) != key):
+            keys.setdefault(key, d['sulffile'])
+            keys[d['sulffile']] = key
+            with open(fname+'.tmp', 'w') as kfile:
+                json.dump(keys, kfile, indent=1, sort_keys=True)
+            os.replace(fname+'.tmp', fname)
+            update_dir_index(fname, True)
+
+
+def check_aero_file():
+    "Test if the current aerosol file was created from the current inventory and forcing files"
+
+    with aero_lock:
+        key = read_aero_keys().get(d['sulffile'])
+    if key is None:
+        return True  # created before its inputs were recorded
+    settings = dict(d.current())
+    with d.using(settings):
+        d.update(get_forcing_files())
+        return calc_aero_file_key() == key
+
+
+def set_aerosol_files():
+    "Define aerosol emission files"
+
+    if d['cmip'] == "cmip5":
+        if d['rcp'] == "historic" or d['rad_year'] < 2010:
+            aero = {'so2_anth': get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_SO2_anthropogenic_{ddyear}*.nc'),
+                    'so2_ship': get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_SO2_ships_{ddyear}*.nc'),
+                    'so2_biom': get_fpath('{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_SO2_decadalmonthlymean{ddyear}*.nc'),
+                    'bc_anth':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_BC_anthropogenic_{ddyear}*.nc'),
+                    'bc_ship':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_BC_ships_{ddyear}*.nc'),
+                    'bc_biom':  get_fpath('{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_BC_decadalmonthlymean{ddyear}*.nc'),
+                    'oc_anth':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_OC_anthropogenic_{ddyear}*.nc'),
+                    'oc_ship':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_OC_ships_{ddyear}*.nc'),
+                    'oc_biom':  get_fpath('{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_OC_decadalmonthlymean{ddyear}*.nc')}
+        elif d['rad_year'] < 2100:
+            aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_anthropogenic_{ddyear}*.nc'),
+                    'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_ships_{ddyear}*.nc'),
+                    'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_biomassburning_{ddyear}*.nc'),
+                    'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_anthropogenic_{ddyear}*.nc'),
+                    'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_ships_{ddyear}*.nc'),
+                    'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_biomassburning_{ddyear}*.nc'),
+                    'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_anthropogenic_{ddyear}*.nc'),
+                    'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_ships_{ddyear}*.nc'),
+                    'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_biomassburning_{ddyear}*.nc')}
         else:
-            run_cmdline('env OMP_NUM_THREADS={nnode} OMP_WAIT_POLICY="PASSIVE" OMP_STACKSIZE=1024m {aeroemiss} -o {sulffile} < aeroemiss.nml > aero.log')
-        check_msg_in_log("aeroemiss","aero.log","aeroemiss completed successfully")
+            aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_anthropogenic_2090*.nc'),
+                    'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_ships_2090*.nc'),
+                    'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_biomassburning_2090*.nc'),
+                    'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_anthropogenic_2090*.nc'),
+                    'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_ships_2090*.nc'),
+                    'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_biomassburning_2090*.nc'),
+                    'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_anthropogenic_2090*.nc'),
+                    'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_ships_2090*.nc'),
+                    'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_biomassburning_2090*.nc')}
+    elif d['cmip'] == "cmip6":
+        if d['rcp'] == "historic" or d['rad_year'] < 2015:
+            aero = {'so2_anth': get_fpath('{stdat}/{cmip}/cmip/SO2-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
+                    'so2_ship': get_fpath('{stdat}/{cmip}/cmip/SO2-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
+                    'so2_biom': get_fpath('{stdat}/{cmip}/cmip/SO2-em-openburning-share_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
+                    'bc_anth':  get_fpath('{stdat}/{cmip}/cmip/BC-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
+                    'bc_ship':  get_fpath('{stdat}/{cmip}/cmip/BC-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
+                    'bc_biom':  get_fpath('{stdat}/{cmip}/cmip/BC-em-openburning-share_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
+                    'oc_anth':  get_fpath('{stdat}/{cmip}/cmip/OC-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
+                    'oc_ship':  get_fpath('{stdat}/{cmip}/cmip/OC-em-anthro_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc'),
+                    'oc_biom':  get_fpath('{stdat}/{cmip}/cmip/OC-em-openburning-share_input4MIPs_emissions_CMIP_CEDS-2017-05-18_gn_{rad_year}*.nc')}
+        else:
+            if d['rcp'] == "ssp126":
+                d['rcplabel'] = "IMAGE"
+            elif d['rcp'] == "ssp245":
+                d['rcplabel'] = "MESSAGE-GLOBIOM"
+            elif d['rcp'] == "ssp370":
+                d['rcplabel'] = "AIM"
+            elif d['rcp'] == "ssp460":
+                d['rcplabel'] = "GCAM4"
+            elif d['rcp'] == "ssp585":
+                d['rcplabel'] = "REMIND-MAGPIE"
+            else:
+                raise ValueError(dict2str("Invalid choice for rcp"))
+
+            if d['rad_year'] < 2020:
+                aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
+                        'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
+                        'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
+                        'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
+                        'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
+                        'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
+                        'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
+                        'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc'),
+                        'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2015*.nc')}
+            elif d['rad_year'] < 2100:
+                aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
+                        'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
+                        'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
+                        'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
+                        'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
+                        'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
+                        'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
+                        'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc'),
+                        'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_{ddyear}*.nc')}
+            else:
+                aero = {'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
+                        'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
+                        'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/SO2-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
+                        'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
+                        'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
+                        'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/BC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
+                        'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
+                        'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-anthro_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc'),
+                        'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/OC-em-openburning-share_input4MIPs_emissions_ScenarioMIP_IAMC-{rcplabel}-{rcp}-1-1_gn_2090*.nc')}
+    else:
+        raise ValueError(dict2str("Invalid choice for cmip"))
+
+    aero['volcano'] = dict2str('{stdat}/contineous_volc.nc')
+    aero['dmsfile'] = dict2str('{stdat}/dmsemiss.nc')
+    aero['dustfile'] = dict2str('{stdat}/ginoux.nc')
+
+    d.update(aero)
 
 
 #===============================================================================
@@ -941,34 +1694,7 @@ def prep_iofiles():
 
     # This function is called if simulation_test=T
 
-    # Define host model fields:
-    d['mesonest'] = dict2str('{bcdom}{iyr}{imth_2digit}.nc')
-    fpath = dict2str('{bcdir}/{mesonest}')
-    if not os.path.exists(fpath):
-        d['mesonest'] = dict2str('{bcdom}.{iyr}{imth_2digit}.nc')
-        fpath = dict2str('{bcdir}/{mesonest}')
-    if not os.path.exists(fpath):
-        d['mesonest'] = dict2str('{bcdom}_{iyr}{imth_2digit}.nc')
-        fpath = dict2str('{bcdir}/{mesonest}')
-    if not os.path.exists(fpath):
-        d['mesonest'] = dict2str('{bcdom}{iyr}{imth_2digit}')
-        fpath = dict2str('{bcdir}/{mesonest}.tar')
-    if not os.path.exists(fpath):
-        d['mesonest'] = dict2str('{bcdom}.{iyr}{imth_2digit}')
-        fpath = dict2str('{bcdir}/{mesonest}.tar')
-    if not os.path.exists(fpath):
-        d['mesonest'] = dict2str('{bcdom}_{iyr}{imth_2digit}')
-        fpath = dict2str('{bcdir}/{mesonest}.tar')
-    if not os.path.exists(fpath):
-        d['mesonest'] = dict2str('{bcdom}.{iyr}{imth_2digit}')
-        fpath = dict2str('{bcdir}/{mesonest}')
-    if not os.path.exists(fpath):
-        if not os.path.exists(fpath+'.000000'):
-            d['mesonest'] = dict2str('{bcdom}{iyr}{imth_2digit}')
-    # no mesonest file required for some dmode options
-    if d['dmode'] in ["sst_only", "aquaplanet1", "aquaplanet2", "aquaplanet3", "aquaplanet4", "aquaplanet5",
-                      "aquaplanet6", "aquaplanet7", "aquaplanet8"]:
-        d['mesonest'] = 'error'
+    find_mesonest()
 
     # Define restart file:
     d['restfile'] = dict2str('Rest{name}.{iyr}{imth_2digit}')
@@ -989,6 +1715,128 @@ def prep_iofiles():
         print("ERROR: Unknown cmip option cmip = ",d['cmip'])
         sys.exit(1)
 
+    # Define ozone, GHG and solar input files:
+    d.update(slice_forcing_files(get_forcing_files(), d['rad_year']))
+
+
+def find_mesonest():
+    "Define the host model file for the current month"
+
+    d['mesonest'] = dict2str('{bcdom}{iyr}{imth_2digit}.nc')
+    fpath = dict2str('{bcdir}/{mesonest}')
+    if not file_exists(fpath):
+        d['mesonest'] = dict2str('{bcdom}.{iyr}{imth_2digit}.nc')
+        fpath = dict2str('{bcdir}/{mesonest}')
+    if not file_exists(fpath):
+        d['mesonest'] = dict2str('{bcdom}_{iyr}{imth_2digit}.nc')
+        fpath = dict2str('{bcdir}/{mesonest}')
+    if not file_exists(fpath):
+        d['mesonest'] = dict2str('{bcdom}{iyr}{imth_2digit}')
+        fpath = dict2str('{bcdir}/{mesonest}.tar')
+    if not file_exists(fpath):
+        d['mesonest'] = dict2str('{bcdom}.{iyr}{imth_2digit}')
+        fpath = dict2str('{bcdir}/{mesonest}.tar')
+    if not file_exists(fpath):
+        d['mesonest'] = dict2str('{bcdom}_{iyr}{imth_2digit}')
+        fpath = dict2str('{bcdir}/{mesonest}.tar')
+    if not file_exists(fpath):
+        d['mesonest'] = dict2str('{bcdom}.{iyr}{imth_2digit}')
+        fpath = dict2str('{bcdir}/{mesonest}')
+    if not file_exists(fpath):
+        if not file_exists(fpath+'.000000'):
+            d['mesonest'] = dict2str('{bcdom}{iyr}{imth_2digit}')
+    # no mesonest file required for some dmode options
+    if d['dmode'] in ["sst_only", "aquaplanet1", "aquaplanet2", "aquaplanet3", "aquaplanet4", "aquaplanet5",
+                      "aquaplanet6", "aquaplanet7", "aquaplanet8"]:
+        d['mesonest'] = 'error'
+
+
+def stage_mesonest():
+    "Stage the host file for the current month in wdir and read its header"
+
+    # tar files are extracted into a separate directory and {mesonest}.staged
+    # marks a complete extraction, which is reused by later jobs.  The host
+    # file is not cut to the region of the nest, since the conformal-cubic
+    # grid covers the globe and is nudged towards the host at every point.
+    fpath = dict2str('{bcdir}/{mesonest}')
+    newpath = dict2str('{wdir}/{mesonest}')
+    cname = "error"
+    if file_exists(fpath):
+        if not file_exists(newpath):
+            link_files(fpath, newpath)
+        cname = newpath
+    elif file_exists(fpath+'.000000'):
+        link_files(fpath+'.??????', '{wdir}')
+        cname = newpath+".000000"
+    elif file_exists(fpath+'.tar'):
+        if not file_exists(newpath+'.staged'):
+            stagedir = dict2str('{wdir}/stage.{mesonest}')
+            os.makedirs(stagedir, exist_ok=True)
+            extract_tar(fpath+'.tar', stagedir)
+            move_files(os.path.join(stagedir, '*'), '{wdir}')
+            shutil.rmtree(stagedir)
+            write2file(newpath+'.staged', '', mode='w+')
+        cname = newpath+".000000"
+    if not file_exists(cname):
+        return None
+
+    staged = {'mesonest': d['mesonest'], 'cname': cname, 'leap': d['leap']}
+    if d['leap'] == "auto":
+        staged['leap'] = check_calendar_in_file(cname, d['leap'])
+    staged['gendata'] = check_attributevalue_in_file(cname, 'driving_experiment_name')
+    # also read by check_correct_host
+    check_var_in_file(cname, ":version")
+    return staged
+
+
+# The host file for the next month is staged in the background while the
+# current month runs (mesoprefetch=on)
+prefetch = {'mesonest': None}
+
+def start_mesonest_prefetch():
+    "Start staging the host file for the next month in the background"
+
+    if d['dmode'] not in ["nudging_gcm", "nudging_ccam", "sst_6hour", "nudging_gcm_with_sst"]:
+        return
+    if (d['mesoprefetch'] != "on") or (prefetch['mesonest'] is not None):
+        return
+    iyr = d['iyr']
+    imth = d['imth'] + 1
+    if imth > 12:
+        iyr = iyr + 1
+        imth = 1
+    if iyr*100 + imth > d['iye']*100 + d['ime']:
+        return
+    settings = dict(d.current())
+    settings.update({'iyr': iyr, 'imth': imth, 'iday': 1})
+    with d.using(settings):
+        set_month_dates()
+        find_mesonest()
+        print("Stage host file "+d['mesonest']+" in the background")
+        prefetch['mesonest'] = launch_task(stage_mesonest)
+
+
+def wait_for_mesonest_prefetch():
+    "Wait for the background staging of the host file and return its header information"
+
+    future = prefetch['mesonest']
+    if future is None:
+        return None
+    prefetch['mesonest'] = None
+    try:
+        staged = future.result()
+    except Exception as err:
+        # config_initconds stages the file again
+        print("WARN: Background staging of host file failed: ", err)
+        return None
+    if (staged is None) or (staged['mesonest'] != d.get('mesonest')):
+        return None
+    return staged
+
+
+def set_ozone_file():
+    "Define ozone file"
+
     # Define ozone infile:
     d['amipo3'] = ".false."
     if d['dmode'] in ["aquaplanet1", "aquaplanet2", "aquaplanet3",
@@ -1020,8 +1868,10 @@ def prep_iofiles():
     else:
         print("ERROR: Unknown cmip option")
         sys.exit(1)
-    # Check ozone file exisits
-    check_file_exists(d['ozone'])
+
+
+def set_ghg_files():
+    "Define GHG and solar files"
 
     # Define GHG input depending on generation of CMIP
     if d['cmip'] == "cmip5":
@@ -1033,9 +1883,6 @@ def prep_iofiles():
         d['cfc113file'] = ""
         d['hcfc22file'] = ""
         d['solarfile'] = ""
-        # verify iofiles exist
-        check_file_exists(d['co2file'])
-
     elif d['cmip'] == "cmip6":
         # check for historical or future GHG concentrations
         if d['rad_year'] < 2015:
@@ -1070,12 +1917,7 @@ def prep_iofiles():
 
         # use time varying solar constant
         d['solarfile'] = dict2str('{stdat}/{cmip}/solarforcing-ref-mon_input4MIPs_solar_CMIP_SOLARIS-HEPPA-3-2_gn_185001-229912.nc')
-        
-        # verify iofiles exist
-        for fname in [d['co2file'], d['ch4file'], d['n2ofile'], d['cfc11file'],
-                      d['cfc12file'], d['cfc113file'], d['hcfc22file'], d['solarfile']]:
-            check_file_exists(fname)
-            
+
     else:
         print("ERROR: Unknown cmip option")
         sys.exit(1)
@@ -1090,7 +1932,7 @@ def locate_tracer_emissions():
         filename = dict2str('{tracer}/tracer.txt')
         if not os.path.exists(filename):
             raise ValueError(dict2str("Cannot locate tracer.txt in {tracer}"))
-        run_cmdline('ln -s {tracer}/* .')
+        link_files('{tracer}/*', '.')
 
 
 def set_mlev_params():
@@ -1112,11 +1954,11 @@ def config_initconds():
     d['nrungcm'] = 0
 
     fname = dict2str('{wdir}/{ifile}.000000')
-    if not os.path.exists(fname):
+    if not file_exists(fname):
         fpath = dict2str('{hdir}/RESTART/{ifile}.tar')
-        if os.path.exists(fpath):
+        if file_exists(fpath):
             print("Missing restart in wdir, but found restart in RESTART directory")
-            run_cmdline('tar xvf '+fpath)
+            extract_tar(fpath)
 
     # Check for cold start
     if d['iyr'] == d['iys']:
@@ -1146,11 +1988,11 @@ def config_initconds():
                 d.update({'ifile': d['sstinit']})
                 fpath = dict2str('{sstinit}')
                 if os.path.exists(fpath):
-                    run_cmdline('ln -s '+fpath+' .')
+                    link_files(fpath, '.')
                 elif os.path.exists(fpath+'.000000'):
-                    run_cmdline('ln -s '+fpath+'.?????? .')
+                    link_files(fpath+'.??????', '.')
                 elif os.path.exists(fpath+'.tar'):
-                    run_cmdline('tar xvf '+fpath+'.tar')
+                    extract_tar(fpath+'.tar')
                 else:
                     raise ValueError(dict2str('ERROR: Cannot locate file {sstinit}'))
             else:
@@ -1169,30 +2011,21 @@ def config_initconds():
 
     # prepare mesonest file
     if d['dmode'] in ["nudging_gcm", "nudging_ccam", "sst_6hour", "nudging_gcm_with_sst"]:
-        fpath = dict2str('{bcdir}/{mesonest}')
-        newpath = dict2str('{wdir}/{mesonest}')
-        cname = "error"
-        if os.path.exists(fpath):
-            if not os.path.exists(newpath):
-                run_cmdline('ln -s '+fpath+' '+newpath)
-            cname = newpath
-        elif os.path.exists(fpath+'.000000'):
-            run_cmdline('ln -s '+fpath+'.?????? .')
-            cname = newpath+".000000"
-        elif os.path.exists(fpath+'.tar'):
-            run_cmdline('tar xvf '+fpath+'.tar')
-            cname = newpath+".000000"
-        if not os.path.exists(cname):
+        staged = wait_for_mesonest_prefetch()
+        if staged is None:
+            staged = stage_mesonest()
+        if staged is None:
             raise ValueError(dict2str('Cannot locate file {bcdir}/{mesonest}'))
+        cname = staged['cname']
 	# update calendar    
         if d['leap'] == "auto":
-            d['leap'] = check_calendar_in_file(cname, d['leap'])
+            d['leap'] = staged['leap']
             if d['leap'] == "auto":
                 print('Check calendar in ',cname)
                 raise ValueError("ERROR: Cannot assign calendar for leap=auto")
             print(dict2str('Assign calendar {leap}'))
         # check match with emission scenario
-        gendata = check_attributevalue_in_file(cname, 'driving_experiment_name')
+        gendata = staged['gendata']
         if (gendata!="") and (gendata!="historical"):
             if gendata == "evaluation":
                 if (d['cmip']=="cmip6") and (d['rcp']!="ssp370"):
@@ -1544,7 +2377,7 @@ def create_input_file():
     d['kdates'] = str(d['iyr']*10000 + d['imth']*100 + d['iday'])
     d['ktimes'] = str(d['ihour']*100)
 
-    write2file('input', input_template_1(), mode='w+')
+    write2file('input', input_template_1(), mode='w+', stage=True)
 
     if d['conv'] == "2014":
         write2file('input', input_template_c2014())
@@ -1590,10 +2423,12 @@ def prepare_ccam_infiles():
         raise ValueError('Cannot locate '+fname)
 
     d['namip'] = 0
+    d['sstinput'] = dict2str('{sstdir}/{sstfile}')
     if d['dmode'] in ['sst_only', 'nudging_gcm_with_sst']:
         fname = dict2str('{sstdir}/{sstfile}')
         if not os.path.exists(fname):
             raise ValueError('Cannot locate '+fname)
+        d['sstinput'] = slice_forcing_file(fname, d['iyr'])
         testrealheader = check_var_in_file(fname, "real_header")    
         if testrealheader is False:
             raise ValueError('Invalid sstfile '+fname+'.  Must use a cubic grid.')
@@ -1648,54 +2483,111 @@ def check_correct_landuse(fname):
     return ( not check_var_in_file(fname,"cableversion") )
 
 
+def check_landuse_files(flist):
+    "Check that land-use files exist and are valid, using recorded results"
+
+    # Results are stored in {vegin}/landuse.json with the size and
+    # modification time of each file, so that a file is only checked again
+    # after it has changed.  Remaining checks run concurrently.
+    rname = dict2str('{vegin}/landuse.json')
+    record = {}
+    if file_exists(rname):
+        try:
+            with open(rname) as rfile:
+                record = json.load(rfile)
+        except (OSError, ValueError):
+            record = {}
+
+    testfail = False
+    pending = []
+    for fname in flist:
+        if not file_exists(fname):
+            testfail = True
+            continue
+        fstat = os.stat(fname)
+        entry = record.get(os.path.basename(fname))
+        if (entry is not None) and (entry['size'] == fstat.st_size) and (entry['mtime'] == fstat.st_mtime_ns):
+            if entry['invalid'] is True:
+                testfail = True
+        else:
+            pending.append((fname, fstat))
+
+    if len(pending) > 0:
+        results = wait_tasks([launch_task(check_correct_landuse, fname) for fname, _ in pending])
+        for (fname, fstat), invalid in zip(pending, results):
+            record[os.path.basename(fname)] = {'size': fstat.st_size, 'mtime': fstat.st_mtime_ns,
+                                               'invalid': invalid}
+            if invalid is True:
+                testfail = True
+        try:
+            with open(rname+'.tmp', 'w') as rfile:
+                json.dump(record, rfile, indent=1, sort_keys=True)
+            os.replace(rname+'.tmp', rname)
+            update_dir_index(rname, True)
+        except OSError as err:
+            print("WARN: Unable to write ",rname," - ",err)
+
+    return testfail
+
+
 def run_model():
     "Execute the CCAM model"
 
+    # ranks reserved for background post-processing are not used by the model
+    d['mproc'] = d['nproc']
+    if d['postprocs'] > 0:
+        d['mproc'] = d['nproc'] - d['postprocs']
+
     # run CCAM
     if d['machinetype'] == "srun":
-        run_cmdline('srun -n {nproc} {model} > prnew.{kdates}.{name} 2> err.{iyr}')
+        run_cmdline('srun -n {mproc} {model} > prnew.{kdates}.{name} 2> err.{iyr}', check=False)
     else:
-        run_cmdline('mpirun -np {nproc} {model} > prnew.{kdates}.{name} 2> err.{iyr}')
+        run_cmdline('mpirun -np {mproc} {model} > prnew.{kdates}.{name} 2> err.{iyr}', check=False)
     prfile = dict2str('prnew.{kdates}.{name}')
-    check_msg_in_log("CCAM",prfile,"globpea completed successfully")
+    check_msg_in_log("CCAM",prfile,"globpea completed successfully",[dict2str('err.{iyr}')])
 
     # clean-up temporary files
+    fname = dict2str('{mesonest}.staged')
+    if file_exists(fname):
+        remove_file(fname)
     fname = dict2str('{mesonest}.000000')
-    if os.path.exists(fname):
-        run_cmdline('rm {mesonest}.??????')
+    if file_exists(fname):
+        remove_files('{mesonest}.??????', background=True)
     fname = dict2str('{mesonest}')
-    if os.path.exists(fname):
-        run_cmdline('rm {mesonest}')
+    if file_exists(fname):
+        remove_files('{mesonest}')
 
     # delete postprocess files so that a subsequent postprocess will update with the new run
     if d['dmode'] != "postprocess":
+        if d['postprocess_test'] is True:
+            drop_post_index(d['ofile'])
         fname = dict2str('{hdir}/daily/pr_{ofile}.nc')
-        if os.path.exists(fname):
-            run_cmdline('rm {hdir}/daily/*_{ofile}.nc')
+        if file_exists(fname):
+            remove_files('{hdir}/daily/*_{ofile}.nc')
         fname = dict2str('{hdir}/daily/{ofile}.nc')
-        if os.path.exists(fname):
-            run_cmdline('rm {hdir}/daily/{ofile}.nc')
+        if file_exists(fname):
+            remove_files('{hdir}/daily/{ofile}.nc')
         fname = dict2str('{hdir}/daily/ccam_{iyr}{imth_2digit}01.nc')
-        if os.path.exists(fname):
-            run_cmdline('rm {hdir}/daily/ccam_{iyr}{imth_2digit}??.nc')
+        if file_exists(fname):
+            remove_files('{hdir}/daily/ccam_{iyr}{imth_2digit}??.nc')
         fname = dict2str('{hdir}/daily_h/pr_{ofile}.nc')
-        if os.path.exists(fname):
-            run_cmdline('rm {hdir}/daily_h/*_{ofile}.nc')
+        if file_exists(fname):
+            remove_files('{hdir}/daily_h/*_{ofile}.nc')
         fname = dict2str('{hdir}/daily_h/{ofile}.nc')
-        if os.path.exists(fname):
-            run_cmdline('rm {hdir}/daily_h/{ofile}.nc')
+        if file_exists(fname):
+            remove_files('{hdir}/daily_h/{ofile}.nc')
         fname = dict2str('{hdir}/daily_t/pr_{ofile}.nc')
-        if os.path.exists(fname):
-            run_cmdline('rm {hdir}/daily_t/*_{ofile}.nc')
+        if file_exists(fname):
+            remove_files('{hdir}/daily_t/*_{ofile}.nc')
         fname = dict2str('{hdir}/daily_t/{ofile}.nc')
-        if os.path.exists(fname):
-            run_cmdline('rm {hdir}/daily_t/{ofile}.nc')            
+        if file_exists(fname):
+            remove_files('{hdir}/daily_t/{ofile}.nc')
         fname = dict2str('{hdir}/cordex/pr_surf.{ofile}.nc')
-        if os.path.exists(fname):
-            run_cmdline('rm {hdir}/cordex/*_surf.{ofile}.nc')
+        if file_exists(fname):
+            remove_files('{hdir}/cordex/*_surf.{ofile}.nc')
         fname = dict2str('{hdir}/highfreq/pr_freq.{ofile}.nc')
-        if os.path.exists(fname):
-            run_cmdline('rm {hdir}/highfreq/*_freq.{ofile}.nc')
+        if file_exists(fname):
+            remove_files('{hdir}/highfreq/*_freq.{ofile}.nc')
 
     # Remove incomplete simulations (treat as spinup)
     #if d['ihour'] > 0:
@@ -1713,89 +2605,57 @@ def run_model():
 # Postprocess
 #===============================================================================
 
-def post_process_output():
-    "Post-process the CCAM model output"
+def post_process_output(edate=None):
+    "Post-process the CCAM model output, up to the month edate (YYYYMM) if given"
     
     hy = d['iys']
     hm = d['ims']
     ftest = True
-    newoutput = False
-    newoutput_h = False
-    newoutput_t = False
-    newcordex = False
-    newhighfreq = False
+    newoutput = {'pressure': False, 'height': False, 'theta': False, 'cordex': False, 'highfreq': False}
     d['drs_host_scenario'] = "error"
     d['drs_host_ensemble'] = "error"
     d['drs_host_name'] = "error"
 
+    # skip the months that are recorded as complete in the output index
+    hy, hm = find_post_index_gap(hy, hm)
+    if (hy>d['iye']) or (hy==d['iye'] and hm>d['ime']):
+        ftest = False
+        if d['dmode'] == "postprocess":
+            # allow simulation to exit
+            d['iyr'] = hy
+            d['imth'] = hm
+    if (edate is not None) and (hy*100+hm > edate):
+        ftest = False
+
     while ftest:
     
         d['histmonth'] = mon_2digit(hm)
         d['histyear'] = hy
         d['histfile'] = dict2str('{name}.{histyear}{histmonth}')
 	    
-        # standard output ------------------------------------------------------
-        outlist = d['outlevmode'].split("_")
-        for outindex in range(len(outlist)):
-
-            d['vertout'] = outlist[outindex]
-            if d['vertout']=="pressure":
-                d['use_plevs'] = 'T'
-                d['use_meters'] = 'F'
-                d['use_theta'] = 'F'
-                d['dailydir'] = 'daily'
-            elif d['vertout']=="height":
-                d['use_plevs'] = 'F'
-                d['use_meters'] = 'T'
-                d['use_theta'] = 'F'
-                d['dailydir'] = 'daily_h'
-            elif d['vertout']=="theta":
-                d['use_plevs'] = 'F'
-                d['use_meters'] = 'F'
-                d['use_theta'] = 'T'
-                d['dailydir'] = 'daily_t'
-            else:
-                raise ValueError('Unknown option for vertical levels')
-
-            if (d['ncout']=="all") or (d['ncout']=="all_s"):
-                singlefile = d['ncout']=="all_s"
-                ftest, newoutput, newoutput_h, newoutput_t = write_output_std("all", singlefile, ftest, newoutput, newoutput_h, newoutput_t)
-
-            if d['ncout'] == "ctm":
-                ftest, newoutput, newoutput_h, newoutput_t = write_output_ctm(ftest, newoutput, newoutput_h, newoutput_t, hy, hm)
+        if d['poststreams'] == "concurrent":
+            # standard, surface and high-frequency output at the same time
+            ftest = post_process_month_streams(hy, hm, ftest, newoutput)
+        else:
+            # standard output --------------------------------------------------
+            # (a tar file is extracted once for all vertical levels)
+            tarflag = extract_raw_output('{histfile}', d['outlevmode'].split("_"))
+            for vertout in d['outlevmode'].split("_"):
+                ftest = post_process_stream(vertout, hy, hm, ftest, newoutput)
+            if tarflag is True:
+                remove_files('{histfile}.??????')
 
-            if (d['ncout']=="basic") or (d['ncout']=="basic_s"):
-                singlefile = d['ncout']=="basic_s"
-                ftest, newoutput, newoutput_h, newoutput_t = write_output_std("basic", singlefile, ftest, newoutput, newoutput_h, newoutput_t)
+            # surface files ----------------------------------------------------
+            ftest = post_process_stream("cordex", hy, hm, ftest, newoutput)
 
-            if d['ncout'] == "tracer":
-                ftest, newoutput, newoutput_h, newoutput_t = write_output_std("tracer", False, ftest, newoutput, newoutput_h, newoutput_t)	    
-                    
-        # store output
-        fname = dict2str('{histfile}')
-        ftest = store_output(ftest, fname)
+            # high-frequency files ---------------------------------------------
+            ftest = post_process_stream("highfreq", hy, hm, ftest, newoutput)
 
-        # surface files --------------------------------------------------------
-        if (d['ncsurf']=="cordex") or (d['ncsurf']=="cordex_s"):
-            singlefile = d['ncsurf']=="cordex_s"
-            ftest, newcordex = write_output_cordex("cordex", singlefile, ftest, newcordex)
-  
         # store output
-        fname = dict2str('surf.{histfile}')
-        ftest = store_output(ftest, fname)
-
-        # high-frequency files -------------------------------------------------
-        if (d['nchigh']=="latlon") or (d['nchigh']=="latlon_s"):
-            singlefile = d['nchigh']=="latlon_s"
-            ftest, newhighfreq = write_output_highfreq("latlon", singlefile, ftest, newhighfreq)
-
-        if (d['nchigh']=="shep") or (d['nchigh']=="shep_s"):
-            singlefile = d['nchigh']=="shep_s"
-            ftest, newhighfreq = write_output_highfreq("shep", singlefile, ftest, newhighfreq)
+        for fname in ['{histfile}', 'surf.{histfile}', 'freq.{histfile}']:
+            ftest = store_output(ftest, dict2str(fname))
 
-        # store output
-        fname = dict2str('freq.{histfile}')
-        ftest = store_output(ftest, fname)
+        record_post_index()
 	
 	# ----------------------------------------------------------------------
 
@@ -1803,7 +2663,8 @@ def post_process_output():
         if hm > 12:
             # create JSON file for DRS if new cordex formatted output was created
             if d['drsmode'] == "on":
-                create_drs(newoutput, newoutput_h, newoutput_t, newcordex, newhighfreq) 
+                create_drs(newoutput['pressure'], newoutput['height'], newoutput['theta'],
+                           newoutput['cordex'], newoutput['highfreq'])
             # Advace year
             hm = 1
             hy = hy + 1
@@ -1815,6 +2676,544 @@ def post_process_output():
                 d['iyr'] = hy
                 d['imth'] = hm
 
+        # later months may still be written by the model
+        if (edate is not None) and (hy*100+hm > edate):
+            ftest = False
+
+
+def set_vertout(vertout):
+    "Define pcc2hist vertical levels and output directory for vertout"
+
+    d['vertout'] = vertout
+    if d['vertout']=="pressure":
+        d['use_plevs'] = 'T'
+        d['use_meters'] = 'F'
+        d['use_theta'] = 'F'
+        d['dailydir'] = 'daily'
+    elif d['vertout']=="height":
+        d['use_plevs'] = 'F'
+        d['use_meters'] = 'T'
+        d['use_theta'] = 'F'
+        d['dailydir'] = 'daily_h'
+    elif d['vertout']=="theta":
+        d['use_plevs'] = 'F'
+        d['use_meters'] = 'F'
+        d['use_theta'] = 'T'
+        d['dailydir'] = 'daily_t'
+    else:
+        raise ValueError('Unknown option for vertical levels')
+
+
+def post_process_stream(stream, hy, hm, ftest=True, newoutput=None, cwd='.'):
+    "Post-process one output stream (pressure, height, theta, cordex or highfreq) of {histfile}"
+
+    # ftest is returned as False if output was processed, and newoutput[stream]
+    # is set to True if new output for DRS was created
+    if newoutput is None:
+        newoutput = {}
+    new = newoutput.get(stream, False)
+
+    if stream in ["pressure", "height", "theta"]:
+        set_vertout(stream)
+        newflags = [stream=="pressure" and new, stream=="height" and new, stream=="theta" and new]
+
+        if (d['ncout']=="all") or (d['ncout']=="all_s"):
+            singlefile = d['ncout']=="all_s"
+            ftest, *newflags = write_output_std("all", singlefile, ftest, *newflags, cwd=cwd)
+
+        if d['ncout'] == "ctm":
+            ftest, *newflags = write_output_ctm(ftest, *newflags, hy, hm, cwd=cwd)
+
+        if (d['ncout']=="basic") or (d['ncout']=="basic_s"):
+            singlefile = d['ncout']=="basic_s"
+            ftest, *newflags = write_output_std("basic", singlefile, ftest, *newflags, cwd=cwd)
+
+        if d['ncout'] == "tracer":
+            ftest, *newflags = write_output_std("tracer", False, ftest, *newflags, cwd=cwd)
+
+        new = any(newflags)
+
+    elif stream == "cordex":
+        if (d['ncsurf']=="cordex") or (d['ncsurf']=="cordex_s"):
+            singlefile = d['ncsurf']=="cordex_s"
+            ftest, new = write_output_cordex("cordex", singlefile, ftest, new, cwd=cwd)
+
+    elif stream == "highfreq":
+        if (d['nchigh']=="latlon") or (d['nchigh']=="latlon_s"):
+            singlefile = d['nchigh']=="latlon_s"
+            ftest, new = write_output_highfreq("latlon", singlefile, ftest, new, cwd=cwd)
+
+        if (d['nchigh']=="shep") or (d['nchigh']=="shep_s"):
+            singlefile = d['nchigh']=="shep_s"
+            ftest, new = write_output_highfreq("shep", singlefile, ftest, new, cwd=cwd)
+
+    else:
+        raise ValueError('Unknown output stream '+stream)
+
+    newoutput[stream] = new
+    return ftest
+
+
+# With --postprocs the completed month is post-processed in the background
+# with postprocs ranks, while the model runs the next month with the
+# remaining ranks.  Only months up to the completed month are processed, and
+# year.qm is only updated by the main loop (or by copy_back_month once the
+# post-processing of the month has finished).
+postproc = {'future': None}
+
+def start_post_process():
+    "Start post-processing the completed months in the background"
+
+    wait_for_post_process()
+    settings = dict(d.current())
+    settings['nproc'] = d['postprocs']
+    with d.using(settings):
+        postproc['future'] = launch_task(post_process_output, d['iyr']*100+d['imth'])
+
+
+def wait_for_post_process():
+    "Wait for the background post-processing of the previous month"
+
+    future = postproc['future']
+    if future is None:
+        return
+    postproc['future'] = None
+    wait_tasks([future])
+
+
+# The months with post-processed output are recorded for each stream in
+# {hdir}/postindex.json, together with the path, a fingerprint, the size and
+# the modification time of the output file, so that post_process_output starts
+# at the first month without output instead of searching for the raw and
+# post-processed files of every month from the start of the run.  An indexed
+# file that is deleted or replaced (fingerprint differs) is treated as
+# missing.  Months are removed when run_model deletes their output, and the
+# index is rebuilt from the files in hdir with --postindex=rebuild or when it
+# is missing.
+post_index = {'data': None, 'changed': False, 'lock': threading.Lock()}
+
+def read_post_index():
+    "Return the post-processed output index, reading or rebuilding it on first use"
+
+    if post_index['data'] is None:
+        fname = dict2str('{hdir}/postindex.json')
+        data = None
+        if d['postindex'] != "rebuild":
+            try:
+                with open(fname) as ifile:
+                    data = json.load(ifile)
+            except (OSError, ValueError):
+                pass
+        post_index['data'] = data
+        if data is None:
+            rebuild_post_index()
+    return post_index['data']
+
+
+def write_post_index():
+    "Write the post-processed output index to {hdir}/postindex.json"
+
+    fname = dict2str('{hdir}/postindex.json')
+    with open(fname+'.tmp', 'w') as ofile:
+        json.dump(post_index['data'], ofile, indent=1, sort_keys=True)
+    os.replace(fname+'.tmp', fname)
+    post_index['changed'] = False
+
+
+def rebuild_post_index():
+    "Rebuild the post-processed output index from the output files in hdir"
+
+    print("Rebuild index of post-processed output")
+    post_index['data'] = {}
+    hy = d['iys']
+    hm = d['ims']
+    while hy*100+hm <= d['iye']*100+d['ime']:
+        settings = dict(d.current())
+        with d.using(settings):
+            d['histmonth'] = mon_2digit(hm)
+            d['histyear'] = hy
+            d['histfile'] = dict2str('{name}.{histyear}{histmonth}')
+            add_post_index_entries()
+        hm = hm + 1
+        if hm > 12:
+            hm = 1
+            hy = hy + 1
+    write_post_index()
+
+
+def add_post_index_entries():
+    "Add the existing output files of {histfile} to the index, and return True if any were added"
+
+    added = False
+    for stream in d['outlevmode'].split("_") + ["cordex", "highfreq"]:
+        fname = post_stream_target(stream)
+        if (fname is None) or check_post_index_entry(stream, fname) or not os.path.exists(fname):
+            continue
+        fstat = os.stat(fname)
+        entries = post_index['data'].setdefault(stream, {})
+        entries[d['histfile']] = [os.path.relpath(fname, d['hdir']), calc_file_fingerprint(fname),
+                                  fstat.st_size, fstat.st_mtime_ns]
+        added = True
+    return added
+
+
+def check_post_index_entry(stream, fname):
+    "Test if the indexed output file of a stream for {histfile} is fname and is unchanged"
+
+    # the fingerprint is only calculated when the size or modification time
+    # has changed, and entries of deleted or replaced files are removed
+    entries = post_index['data'].get(stream, {})
+    entry = entries.get(d['histfile'])
+    if (entry is None) or (os.path.join(d['hdir'], entry[0]) != fname):
+        return False
+    try:
+        fstat = os.stat(fname)
+    except OSError:
+        fstat = None
+    if (fstat is not None) and (entry[2:] == [fstat.st_size, fstat.st_mtime_ns]):
+        return True
+    post_index['changed'] = True
+    if (fstat is None) or (calc_file_fingerprint(fname) != entry[1]):
+        del entries[d['histfile']]
+        return False
+    entry[2:] = [fstat.st_size, fstat.st_mtime_ns]
+    return True
+
+
+def find_post_index_gap(hy, hm):
+    "Return the first month from hy, hm without indexed output for all streams"
+
+    if d['postindex'] == "off":
+        return hy, hm
+    settings = dict(d.current())
+    with d.using(settings), post_index['lock']:
+        read_post_index()
+        gap = False
+        while (gap is False) and (hy*100+hm <= d['iye']*100+d['ime']):
+            d['histmonth'] = mon_2digit(hm)
+            d['histyear'] = hy
+            d['histfile'] = dict2str('{name}.{histyear}{histmonth}')
+            for stream in d['outlevmode'].split("_") + ["cordex", "highfreq"]:
+                fname = post_stream_target(stream)
+                if (fname is not None) and not check_post_index_entry(stream, fname):
+                    gap = True
+                    break
+            if gap is False:
+                hm = hm + 1
+                if hm > 12:
+                    hm = 1
+                    hy = hy + 1
+        if post_index['changed'] is True:
+            write_post_index()
+    return hy, hm
+
+
+def record_post_index_upto(edate):
+    "Record the output files of the months up to edate (YYYYMM) in the post-processed output index"
+
+    if d['postindex'] == "off":
+        return
+    hy, hm = find_post_index_gap(d['iys'], d['ims'])
+    while hy*100+hm <= edate:
+        settings = dict(d.current())
+        with d.using(settings):
+            d['histmonth'] = mon_2digit(hm)
+            d['histyear'] = hy
+            d['histfile'] = dict2str('{name}.{histyear}{histmonth}')
+            record_post_index()
+        hm = hm + 1
+        if hm > 12:
+            hm = 1
+            hy = hy + 1
+
+
+def record_post_index():
+    "Record the output files of {histfile} in the post-processed output index"
+
+    if d['postindex'] == "off":
+        return
+    settings = dict(d.current())
+    with d.using(settings), post_index['lock']:
+        read_post_index()
+        if add_post_index_entries() or (post_index['changed'] is True):
+            write_post_index()
+
+
+def drop_post_index(histfile):
+    "Remove a month from the post-processed output index"
+
+    if d['postindex'] == "off":
+        return
+    with post_index['lock']:
+        read_post_index()
+        found = False
+        for entries in post_index['data'].values():
+            if entries.pop(histfile, None) is not None:
+                found = True
+        if found:
+            write_post_index()
+
+
+# With --postmode=backlog, dmode=postprocess finds all months and streams
+# without post-processed output before starting, and runs a pcc2hist job for
+# each of them concurrently.  The nproc ranks are shared between the jobs,
+# and the jobs with the most raw output are started first.
+
+def post_stream_prefix(stream):
+    "Return the prefix of the raw output files of a stream"
+
+    if stream == "cordex":
+        return 'surf.'
+    if stream == "highfreq":
+        return 'freq.'
+    return ''
+
+
+def post_stream_target(stream):
+    "Return the post-processed output file of a stream for {histfile}, or None if not requested"
+
+    if stream in ["pressure", "height", "theta"]:
+        set_vertout(stream)
+        if d['ncout'] == "ctm":
+            return dict2str("{hdir}/daily/ccam_{histyear}{histmonth}01.nc")
+        if d['ncout'] == "tracer":
+            return dict2str('{hdir}/{dailydir}/trav0001_{histfile}.nc')
+        if d['ncout'] in ["all_s", "basic_s"]:
+            return dict2str('{hdir}/{dailydir}/{histfile}.nc')
+        if d['ncout'] in ["all", "basic"]:
+            return dict2str('{hdir}/{dailydir}/pr_{histfile}.nc')
+    elif stream == "cordex":
+        if d['ncsurf'] == "cordex_s":
+            return dict2str('{hdir}/cordex/surf.{histfile}.nc')
+        if d['ncsurf'] == "cordex":
+            return dict2str('{hdir}/cordex/pr_surf.{histfile}.nc')
+    elif stream == "highfreq":
+        if d['nchigh'] in ["latlon_s", "shep_s"]:
+            return dict2str('{hdir}/highfreq/freq.{histfile}.nc')
+        if d['nchigh'] in ["latlon", "shep"]:
+            return dict2str('{hdir}/highfreq/rnd_freq.{histfile}.nc')
+    return None
+
+
+def post_stream_pending(stream):
+    "Test if a stream of {histfile} is requested and has no post-processed output"
+
+    fname = post_stream_target(stream)
+    return (fname is not None) and not os.path.exists(fname)
+
+
+def find_post_jobs(hy, hm):
+    "Return a job for each stream of a month with raw output but without post-processed output"
+
+    jobs = []
+    settings = dict(d.current())
+    with d.using(settings):
+        d['histmonth'] = mon_2digit(hm)
+        d['histyear'] = hy
+        d['histfile'] = dict2str('{name}.{histyear}{histmonth}')
+        for stream in d['outlevmode'].split("_") + ["cordex", "highfreq"]:
+            if not post_stream_pending(stream):
+                continue
+            raw = post_stream_prefix(stream) + d['histfile']
+            if file_exists(raw+'.000000'):
+                size = sum(os.path.getsize(cname) for cname in match_files(raw+'.??????'))
+                tname = None
+            elif file_exists(raw+'.tar'):
+                size = os.path.getsize(raw+'.tar')
+                tname = raw+'.tar'
+            else:
+                continue
+            jobs.append({'stream': stream, 'year': hy, 'month': hm, 'raw': raw, 'tar': tname,
+                         'size': size, 'settings': dict(settings), 'ranks': 1, 'ftest': True,
+                         'new': False})
+    return jobs
+
+
+def find_post_backlog():
+    "Return the jobs for all months and streams of the run without post-processed output"
+
+    jobs = []
+    hy = d['iys']
+    hm = d['ims']
+    while hy*100+hm <= d['iye']*100+d['ime']:
+        jobs.extend(find_post_jobs(hy, hm))
+        hm = hm + 1
+        if hm > 12:
+            hm = 1
+            hy = hy + 1
+    return jobs
+
+
+def post_process_backlog():
+    "Post-process all months and streams of the run without output concurrently"
+
+    d['drs_host_scenario'] = "error"
+    d['drs_host_ensemble'] = "error"
+    d['drs_host_name'] = "error"
+    jobs = find_post_backlog()
+    if len(jobs) == 0:
+        print("No CCAM output left to post-process")
+    else:
+        # each job has the ranks it would have when the streams of a single
+        # month run together, and the remaining jobs wait for free ranks
+        nstreams = len(set(job['stream'] for job in jobs))
+        ranks = max(1, d['nproc'] // min(len(jobs), nstreams))
+        print("Post-process {0} months and streams with {1} ranks each".format(len(jobs), ranks))
+        for job in jobs:
+            job['ranks'] = ranks
+        run_post_jobs(jobs, store=True)
+
+        # create JSON files for DRS for each year with new output
+        if d['drsmode'] == "on":
+            for hy in sorted(set(job['year'] for job in jobs)):
+                yjobs = [job for job in jobs if job['year'] == hy]
+                newoutput = {}
+                for job in yjobs:
+                    newoutput[job['stream']] = newoutput.get(job['stream'], False) or job['new']
+                yjobs.sort(key=lambda job: job['new'])
+                with d.using(dict(yjobs[-1]['settings'])):
+                    create_drs(newoutput.get('pressure', False), newoutput.get('height', False),
+                               newoutput.get('theta', False), newoutput.get('cordex', False),
+                               newoutput.get('highfreq', False))
+
+    # allow simulation to exit
+    d['iyr'] = d['iye']
+    d['imth'] = d['ime'] + 1
+    if d['imth'] > 12:
+        d['imth'] = 1
+        d['iyr'] = d['iye'] + 1
+
+
+# With --poststreams=concurrent, all the streams of a month (pressure, height
+# and theta levels, surface and high-frequency output) are post-processed at
+# the same time.  The nproc ranks are shared between the streams in
+# proportion to the size of the raw output that each of them reads.
+
+def post_process_month_streams(hy, hm, ftest, newoutput):
+    "Post-process the output streams of {histfile} concurrently"
+
+    jobs = find_post_jobs(hy, hm)
+    if len(jobs) == 0:
+        return ftest
+
+    # ranks left over from rounding go to the largest stream
+    total = sum(job['size'] for job in jobs)
+    for job in jobs:
+        job['ranks'] = max(1, d['nproc']*job['size']//max(total, 1))
+    largest = max(jobs, key=lambda job: job['size'])
+    largest['ranks'] += max(0, d['nproc']-sum(job['ranks'] for job in jobs))
+    run_post_jobs(jobs)
+
+    for job in jobs:
+        if job['ftest'] is False:
+            ftest = False
+        newoutput[job['stream']] = newoutput.get(job['stream'], False) or job['new']
+        for key in ['drs_host_scenario', 'drs_host_ensemble', 'drs_host_name', 'drs_host_institution']:
+            if job['settings'].get(key, "error") != "error":
+                d[key] = job['settings'][key]
+    return ftest
+
+
+# Each job works in its own directory post.{histfile}.{stream} (with its own
+# cc.nml) and links to the raw output files.  A tar file is extracted once
+# into post.{histfile} (or post.surf.{histfile}, etc) for all the jobs that
+# read it, and removed after the last of them has finished.
+
+def run_post_jobs(jobs, store=False):
+    "Run post-processing jobs, largest first, with the ranks of each job"
+
+    graph = []
+    tars = {}
+    for job in jobs:
+        if job['tar'] is not None:
+            tars.setdefault(job['tar'], []).append(job)
+    # only as many tar files as jobs that can run at once are extracted at
+    # the same time (largest first), so that the backlog does not fill the disk
+    window = max(1, d['nproc'] // min(job['ranks'] for job in jobs))
+    tnames = sorted(tars, key=lambda tname: max(job['size'] for job in tars[tname]), reverse=True)
+    for i, tname in enumerate(tnames):
+        after = []
+        if i >= window:
+            after = ['clean.'+tnames[i-window]]
+        graph.append(graph_task('untar.'+tname, functools.partial(extract_post_tar, tname), after))
+    for job in sorted(jobs, key=lambda job: job['size'], reverse=True):
+        after = []
+        if job['tar'] is not None:
+            after = ['untar.'+job['tar']]
+        graph.append(graph_task(post_job_name(job), functools.partial(run_post_job, job),
+                                after, job['ranks']))
+    for tname, tjobs in tars.items():
+        graph.append(graph_task('clean.'+tname, functools.partial(shutil.rmtree, post_tar_dir(tname)),
+                                [post_job_name(job) for job in tjobs]))
+    if store is True:
+        # the raw output of a month is stored after all of its jobs have finished
+        months = {}
+        for job in jobs:
+            months.setdefault(job['settings']['histfile'], []).append(job)
+        for histfile, mjobs in months.items():
+            graph.append(graph_task('store.'+histfile, functools.partial(store_post_output, mjobs[0]['settings']),
+                                    [post_job_name(job) for job in mjobs]))
+    run_task_graph(graph)
+
+
+def post_job_name(job):
+    "Return the task name of a post-processing job"
+
+    return job['raw']+'.'+job['stream']
+
+
+def post_tar_dir(tname):
+    "Return the directory for the extracted raw output of a tar file"
+
+    return os.path.abspath('post.'+tname[:-len('.tar')])
+
+
+def extract_post_tar(tname):
+    "Extract a tar file of raw output for the post-processing jobs"
+
+    os.makedirs(post_tar_dir(tname), exist_ok=True)
+    extract_tar(tname, post_tar_dir(tname))
+
+
+def run_post_job(job):
+    "Run pcc2hist for one month and stream in its own directory"
+
+    with d.using(job['settings']):
+        d['nproc'] = job['ranks']
+        print(dict2str("-> Post-process {histfile} "+job['stream']+" output with {nproc} ranks"))
+        cwd = os.path.abspath(dict2str('post.{histfile}.')+job['stream'])
+        src = os.path.abspath('.')
+        if job['tar'] is not None:
+            src = post_tar_dir(job['tar'])
+        os.makedirs(cwd, exist_ok=True)
+        link_files(os.path.join(src, job['raw']+'.??????'), cwd)
+        newoutput = {}
+        job['ftest'] = post_process_stream(job['stream'], job['year'], job['month'], True, newoutput, cwd)
+        job['new'] = newoutput[job['stream']]
+        shutil.rmtree(cwd)
+        record_post_index()
+
+
+def store_post_output(settings):
+    "Move, tar or delete the raw output of a post-processed month"
+
+    with d.using(dict(settings)):
+        for fname in ['{histfile}', 'surf.{histfile}', 'freq.{histfile}']:
+            store_output(True, dict2str(fname))
+
+
+def extract_raw_output(raw, streams):
+    "Extract the raw output of the pending streams from its tar file, and return True if extracted"
+
+    settings = dict(d.current())
+    with d.using(settings):
+        if not any(post_stream_pending(stream) for stream in streams):
+            return False
+    if file_exists(dict2str(raw+'.000000')) or not file_exists(dict2str(raw+'.tar')):
+        return False
+    extract_tar(raw+'.tar')
+    return True
+
 
 def set_postprocess_options(fname):
     "Define settings for postprocess"
@@ -1872,7 +3271,7 @@ def set_postprocess_options(fname):
         print(dict2str("-> Adjust maxlon to {maxlon}"))
 
 
-def write_output_std(outmode, singlefile, ftest, newoutput, newoutput_h, newoutput_t):
+def write_output_std(outmode, singlefile, ftest, newoutput, newoutput_h, newoutput_t, cwd='.'):
     "Write standard output for all variables"
     
     # check if output already exists
@@ -1887,12 +3286,12 @@ def write_output_std(outmode, singlefile, ftest, newoutput, newoutput_h, newoutp
     
         # open tar file if necessary
         tarflag = False
-        cname = dict2str('{histfile}.000000')
+        cname = os.path.join(cwd, dict2str('{histfile}.000000'))
         if not os.path.exists(cname):
-            tname = dict2str('{histfile}.tar')
+            tname = os.path.join(cwd, dict2str('{histfile}.tar'))
             if os.path.exists(tname):
                 tarflag = True
-                run_cmdline('tar xvf '+tname)
+                extract_tar(tname, cwd)
 
         # star processing data if present 	
         if os.path.exists(cname):
@@ -1905,36 +3304,36 @@ def write_output_std(outmode, singlefile, ftest, newoutput, newoutput_h, newoutp
     
             # Run pcc2hist to extract data from raw cubic data
             if outmode == "all":
-                write2file('cc.nml', cc_template_all(), mode='w+')
+                write2file(os.path.join(cwd, 'cc.nml'), cc_template_all(cwd), mode='w+')
             elif outmode == "basic":		
-                write2file('cc.nml', cc_template_basic(), mode='w+')
+                write2file(os.path.join(cwd, 'cc.nml'), cc_template_basic(cwd), mode='w+')
             elif outmode == "tracer":
-                write2file('cc.nml', cc_template_tracer(), mode='w+')
+                write2file(os.path.join(cwd, 'cc.nml'), cc_template_tracer(cwd), mode='w+')
             else:
                 print("ERROR Unknown outmode in write_output_std outmode=",outmode)
                 sys.exit(1)
 
             if singlefile is True:
                 if d['machinetype'] == "srun":
-                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --interp=linear > pcc2hist.log')
+                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --interp=linear > pcc2hist.log', check=False, cwd=cwd)
                 else:
-                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --interp=linear > pcc2hist.log')
+                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --interp=linear > pcc2hist.log', check=False, cwd=cwd)
             else:
                 if d['machinetype'] == "srun":
-                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --multioutput --interp=linear > pcc2hist.log')
+                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --multioutput --interp=linear > pcc2hist.log', check=False, cwd=cwd)
                 else:
-                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --multioutput --interp=linear > pcc2hist.log')
-            check_msg_in_log("pcc2hist","pcc2hist.log","pcc2hist completed successfully")
+                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --multioutput --interp=linear > pcc2hist.log', check=False, cwd=cwd)
+            check_msg_in_log("pcc2hist",os.path.join(cwd, "pcc2hist.log"),"pcc2hist completed successfully")
     
             # move fles from working directory to archive directory
             if singlefile:
-                run_cmdline('mv {histfile}.nc {hdir}/{dailydir}')
+                move_files(os.path.join(cwd, '{histfile}.nc'), copyback_dir('{hdir}/{dailydir}'))
             else:    
-                run_cmdline('mv *_{histfile}.nc {hdir}/{dailydir}')
+                move_files(os.path.join(cwd, '*_{histfile}.nc'), copyback_dir('{hdir}/{dailydir}'))
 
             # clean up temporary files
             if tarflag is True:
-                run_cmdline('rm {histfile}.??????')
+                remove_files(os.path.join(cwd, '{histfile}.??????'))
 		
             # set flags for postprocess loop in calling function
             ftest = False
@@ -1948,7 +3347,7 @@ def write_output_std(outmode, singlefile, ftest, newoutput, newoutput_h, newoutp
     return ftest, newoutput, newoutput_h, newoutput_t
 
 
-def write_output_ctm(ftest, newoutput, newoutput_h, newoutput_t, hy, hm):
+def write_output_ctm(ftest, newoutput, newoutput_h, newoutput_t, hy, hm, cwd='.'):
     "Write CTM output"
     
     # CTM expects hourly ouput
@@ -1960,12 +3359,12 @@ def write_output_ctm(ftest, newoutput, newoutput_h, newoutput_t, hy, hm):
     if not os.path.exists(fname):
     
         tarflag = False
-        cname = dict2str('{histfile}.000000')
+        cname = os.path.join(cwd, dict2str('{histfile}.000000'))
         if not os.path.exists(cname):
-            tname = dict2str('{histfile}.tar')
+            tname = os.path.join(cwd, dict2str('{histfile}.tar'))
             if os.path.exists(tname):
                 tarflag = True
-                run_cmdline('tar xvf '+tname)
+                extract_tar(tname, cwd)
 		    
         if os.path.exists(cname):
 
@@ -1998,16 +3397,16 @@ def write_output_ctm(ftest, newoutput, newoutput_h, newoutput_t, hy, hm):
                 d['iend'] = (iday-idaystart+1)*1440
                 d['istart'] = (iday-idaystart)*1440
                 d['outctmfile'] = dict2str("ccam_{histyear}{histmonth}{cday}.nc")
-                write2file('cc.nml', cc_template_ctm(), mode='w+')
+                write2file(os.path.join(cwd, 'cc.nml'), cc_template_ctm(cwd), mode='w+')
                 if d['machinetype'] == "srun":
-                    run_cmdline('srun -n {nproc} {pcc2hist} --interp=linear > pcc2hist_ctm.log')
+                    run_cmdline('srun -n {nproc} {pcc2hist} --interp=linear > pcc2hist_ctm.log', check=False, cwd=cwd)
                 else:
-                    run_cmdline('mpirun -np {nproc} {pcc2hist} --interp=linear > pcc2hist_ctm.log')
-                check_msg_in_log("pcc2hist","pcc2hist.log","pcc2hist completed successfully")    
+                    run_cmdline('mpirun -np {nproc} {pcc2hist} --interp=linear > pcc2hist_ctm.log', check=False, cwd=cwd)
+                check_msg_in_log("pcc2hist",os.path.join(cwd, "pcc2hist_ctm.log"),"pcc2hist completed successfully")
 		
-            run_cmdline('mv ccam_{histyear}{histmonth}??.nc {hdir}/daily')
+            move_files(os.path.join(cwd, 'ccam_{histyear}{histmonth}??.nc'), copyback_dir('{hdir}/daily'))
             if tarflag is True:
-                run_cmdline('rm {histfile}.??????')
+                remove_files(os.path.join(cwd, '{histfile}.??????'))
             ftest = False
             # No DRS output for CTM formatting
             newoutput = False
@@ -2015,7 +3414,7 @@ def write_output_ctm(ftest, newoutput, newoutput_h, newoutput_t, hy, hm):
     return ftest, newoutput, newoutput_h, newoutput_t
 
 
-def write_output_cordex(outmode, singlefile, ftest, newcordex):
+def write_output_cordex(outmode, singlefile, ftest, newcordex, cwd='.'):
     "Write CORDEX output"
 
     if singlefile is True:
@@ -2026,12 +3425,12 @@ def write_output_cordex(outmode, singlefile, ftest, newcordex):
     if not os.path.exists(fname):
     
         tarflag = False
-        cname = dict2str('surf.{histfile}.000000')
+        cname = os.path.join(cwd, dict2str('surf.{histfile}.000000'))
         if not os.path.exists(cname):
-            tname = dict2str('surf.{histfile}.tar')
+            tname = os.path.join(cwd, dict2str('surf.{histfile}.tar'))
             if os.path.exists(tname):
                 tarflag = True
-                run_cmdline('tar xvf '+tname)    
+                extract_tar(tname, cwd)    
 
         if os.path.exists(cname):
 
@@ -2042,30 +3441,30 @@ def write_output_cordex(outmode, singlefile, ftest, newcordex):
             calc_drs_host(cname)
 	    
             if outmode == "cordex":
-                write2file('cc.nml', cc_template_cordex(), mode='w+')
+                write2file(os.path.join(cwd, 'cc.nml'), cc_template_cordex(cwd), mode='w+')
             else:
                 print("ERROR Unknown outmode for write_output_cordex outmode=",outmode)
                 sys.exit(1)		
 	    
             if singlefile is True:
                 if d['machinetype'] == "srun":
-                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --interp=linear > surf.pcc2hist.log')
+                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --interp=linear > surf.pcc2hist.log', check=False, cwd=cwd)
                 else:
-                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --interp=linear > surf.pcc2hist.log')
+                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --interp=linear > surf.pcc2hist.log', check=False, cwd=cwd)
             else:
                 if d['machinetype'] == "srun":
-                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --multioutput --interp=linear > surf.pcc2hist.log')
+                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --multioutput --interp=linear > surf.pcc2hist.log', check=False, cwd=cwd)
                 else:
-                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --multioutput --interp=linear > surf.pcc2hist.log')
-            check_msg_in_log("pcc2hist","surf.pcc2hist.log","pcc2hist completed successfully")
+                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --multioutput --interp=linear > surf.pcc2hist.log', check=False, cwd=cwd)
+            check_msg_in_log("pcc2hist",os.path.join(cwd, "surf.pcc2hist.log"),"pcc2hist completed successfully")
 	    
             if singlefile is True:
-                run_cmdline('mv surf.{histfile}.nc {hdir}/cordex')
+                move_files(os.path.join(cwd, 'surf.{histfile}.nc'), copyback_dir('{hdir}/cordex'))
             else:    
-                run_cmdline('mv *_surf.{histfile}.nc {hdir}/cordex')
+                move_files(os.path.join(cwd, '*_surf.{histfile}.nc'), copyback_dir('{hdir}/cordex'))
 		
             if tarflag is True:
-                run_cmdline('rm surf.{histfile}.??????')
+                remove_files(os.path.join(cwd, 'surf.{histfile}.??????'))
 
             ftest = False
             newcordex = True
@@ -2073,7 +3472,7 @@ def write_output_cordex(outmode, singlefile, ftest, newcordex):
     return ftest, newcordex
 
 
-def write_output_highfreq(outmode, singlefile, ftest, newhighfreq):
+def write_output_highfreq(outmode, singlefile, ftest, newhighfreq, cwd='.'):
     "Write high-frequency output"
     
     if singlefile is True:
@@ -2084,12 +3483,12 @@ def write_output_highfreq(outmode, singlefile, ftest, newhighfreq):
     if not os.path.exists(fname):
 	    
         tarflag = False
-        cname = dict2str('freq.{histfile}.000000')
+        cname = os.path.join(cwd, dict2str('freq.{histfile}.000000'))
         if not os.path.exists(cname):
-            tname = dict2str('freq.{histfile}.tar')
+            tname = os.path.join(cwd, dict2str('freq.{histfile}.tar'))
             if os.path.exists(tname):
                 tarflag = True
-                run_cmdline('tar xvf '+tname)    
+                extract_tar(tname, cwd)    
 
         if os.path.exists(cname):
 
@@ -2100,32 +3499,32 @@ def write_output_highfreq(outmode, singlefile, ftest, newhighfreq):
             calc_drs_host(cname)
 
             if outmode == "latlon":
-                write2file('cc.nml', cc_template_latlon(), mode='w+')
-            if outmode == "shep":
-                write2file('cc.nml', cc_template_shep(), mode='w+')
+                write2file(os.path.join(cwd, 'cc.nml'), cc_template_latlon(cwd), mode='w+')
+            elif outmode == "shep":
+                write2file(os.path.join(cwd, 'cc.nml'), cc_template_shep(cwd), mode='w+')
             else:
                 print("ERROR Unknown outmode for write_output_latlon outmode=",outmode)
                 sys.exit(1)		
 		
             if singlefile is True:
                 if d['machinetype'] == "srun":
-                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --interp=linear > freq.pcc2hist.log')
+                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --interp=linear > freq.pcc2hist.log', check=False, cwd=cwd)
                 else:
-                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --interp=linear > freq.pcc2hist.log')
+                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --interp=linear > freq.pcc2hist.log', check=False, cwd=cwd)
             else:
                 if d['machinetype'] == "srun":
-                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --multioutput --interp=linear > freq.pcc2hist.log')
+                    run_cmdline('srun -n {nproc} {pcc2hist} --cordex --multioutput --interp=linear > freq.pcc2hist.log', check=False, cwd=cwd)
                 else:
-                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --multioutput --interp=linear > freq.pcc2hist.log')
-            check_msg_in_log("pcc2hist","freq.pcc2hist.log","pcc2hist completed successfully")
+                    run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex --multioutput --interp=linear > freq.pcc2hist.log', check=False, cwd=cwd)
+            check_msg_in_log("pcc2hist",os.path.join(cwd, "freq.pcc2hist.log"),"pcc2hist completed successfully")
 	    
             if singlefile is True:
-                run_cmdline('mv freq.{histfile}.nc {hdir}/highfreq')                    
+                move_files(os.path.join(cwd, 'freq.{histfile}.nc'), copyback_dir('{hdir}/highfreq'))
             else:
-                run_cmdline('mv *_freq.{histfile}.nc {hdir}/highfreq')
+                move_files(os.path.join(cwd, '*_freq.{histfile}.nc'), copyback_dir('{hdir}/highfreq'))
 		
             if tarflag is True:
-                run_cmdline('rm {histfile}.??????')
+                remove_files(os.path.join(cwd, 'freq.{histfile}.??????'))
 		
             ftest = False
             newhighfreq = True
@@ -2139,20 +3538,20 @@ def store_output(ftest, fname):
     if (d['nctar']=="off") and (d['dmode']!="postprocess"):
         cname = dict2str(fname+'.000000')
         if os.path.exists(cname):
-            run_cmdline('mv '+fname+'.?????? {hdir}/OUTPUT')
+            move_files(fname+'.??????', copyback_dir('{hdir}/OUTPUT'))
             ftest = False
 
     if d['nctar'] == "tar":
         cname = dict2str(fname+'.000000')
         if os.path.exists(cname):
-            run_cmdline('tar cvf {hdir}/OUTPUT/'+fname+'.tar '+fname+'.??????')
-            run_cmdline('rm '+fname+'.??????')
+            create_tar(os.path.join(copyback_dir('{hdir}/OUTPUT'), fname+'.tar'), fname+'.??????')
+            remove_files(fname+'.??????')
             ftest = False
 
     if d['nctar'] == "delete":
         cname = dict2str(fname+'.000000')
         if os.path.exists(cname):
-            run_cmdline('rm '+fname+'.??????')
+            remove_files(fname+'.??????')
             ftest = False                    
 
     return ftest
@@ -2279,10 +3678,398 @@ def create_drs(newoutput, newoutput_h, newoutput_t, newcordex, newhighfreq):
 # Miscellaneous
 #===============================================================================
 
-def run_cmdline(arg):
+def run_cmdline(arg, check=True, cwd=None):
     "Run a command line argument from within python"
 
-    os.system(dict2str(arg))
+    return run_cmdlines([arg], check=check, cwd=cwd)[0]
+
+
+def run_cmdlines(args, check=True, cwd=None):
+    "Run independent command line arguments concurrently"
+
+    return wait_tasks([launch_cmdline(arg, cwd=cwd) for arg in args], check=check)
+
+
+def launch_cmdline(arg, cwd=None):
+    "Start a command line argument and return a future for its record"
+
+    # command lines run on their own thread pool, so that tasks waiting for
+    # command lines never hold the workers that the command lines need
+    loop = get_engine_loop()
+    return asyncio.run_coroutine_threadsafe(exec_task(engine['cmdpool'], d.current(), exec_cmdline,
+                                                      dict2str(arg), cwd), loop)
+
+
+def launch_task(func, *args):
+    "Start a function on the execution engine and return its future"
+
+    # the task uses the settings that are active in the calling thread
+    return asyncio.run_coroutine_threadsafe(exec_task(None, d.current(), func, *args), get_engine_loop())
+
+
+def wait_tasks(futures, check=True):
+    "Wait for launched command lines or functions to complete"
+
+    # all tasks are allowed to finish before errors are raised
+    results = []
+    errors = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as err:
+            errors.append(err)
+            results.append(None)
+    if len(errors) > 0:
+        raise errors[0]
+    if check is True:
+        for record in results:
+            if isinstance(record, dict) and ('exitcode' in record) and (record['exitcode'] != 0):
+                raise ValueError("Command failed with exit code "+str(record['exitcode'])+": "+record['cmd'])
+    return results
+
+
+def graph_task(name, func, after=None, threads=1):
+    "Define a task for run_task_graph"
+
+    if after is None:
+        after = []
+    return {'name': name, 'func': func, 'after': after, 'threads': threads}
+
+
+def run_task_graph(graph):
+    "Run tasks once the tasks they depend on have completed"
+
+    # Tasks are launched as soon as their dependencies are complete and
+    # enough of the nproc cores are free for their threads (a task is always
+    # launched when nothing else is running).  Dependencies on tasks that are
+    # not part of the graph are ignored.
+    names = set(task['name'] for task in graph)
+    pending = list(graph)
+    running = {}
+    times = {}
+    used = 0
+    start = time.perf_counter()
+    while (len(pending) > 0) or (len(running) > 0):
+        for task in list(pending):
+            ready = all((dep in times) and (len(times[dep]) == 2) for dep in task['after'] if dep in names)
+            if ready and ((used+task['threads'] <= d['nproc']) or (len(running) == 0)):
+                pending.remove(task)
+                used += task['threads']
+                times[task['name']] = [time.perf_counter()-start]
+                running[launch_task(task['func'])] = task
+        if len(running) == 0:
+            raise ValueError("Cannot resolve task dependencies: "+", ".join(task['name'] for task in pending))
+        finished, _ = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            task = running.pop(future)
+            used -= task['threads']
+            times[task['name']].append(time.perf_counter()-start)
+            if future.exception() is not None:
+                # let the other tasks finish before reporting the error
+                concurrent.futures.wait(list(running))
+                raise future.exception()
+
+    if len(graph) > 1:
+        report_critical_path(graph, times)
+
+
+def report_critical_path(graph, times):
+    "Print the chain of dependent tasks that determined the wall time"
+
+    names = set(task['name'] for task in graph)
+    path = {}
+    for task in sorted(graph, key=lambda task: times[task['name']][1]):
+        wall = times[task['name']][1] - times[task['name']][0]
+        prev = [path[dep] for dep in task['after'] if dep in path]
+        best = max(prev, key=lambda item: item[0], default=(0., []))
+        path[task['name']] = (best[0]+wall, best[1]+[(task['name'], wall)])
+    total, chain = max(path.values(), key=lambda item: item[0])
+    wall = max(end for _, end in times.values())
+    print("-> Critical path "+" -> ".join("{0} ({1:.1f}s)".format(name, t) for name, t in chain)+
+          " = {0:.1f}s of {1:.1f}s".format(total, wall))
+
+
+def get_engine_loop():
+    "Return the event loop of the execution engine, starting it if required"
+
+    with engine['lock']:
+        if engine['loop'] is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=64))
+            # threads are only created when needed
+            engine['cmdpool'] = concurrent.futures.ThreadPoolExecutor(max_workers=1024)
+            thread = threading.Thread(target=loop.run_forever, daemon=True)
+            thread.start()
+            engine['loop'] = loop
+    return engine['loop']
+
+
+async def exec_task(executor, settings, func, *args):
+    "Execute a blocking function on an engine thread pool (None for the default pool)"
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, call_with_settings, settings, func, *args)
+
+
+def call_with_settings(settings, func, *args):
+    "Call a function with the given run settings active"
+
+    with d.using(settings):
+        return func(*args)
+
+
+def exec_cmdline(cmd, cwd=None):
+    "Execute a command line and record its exit code and resource usage"
+
+    # os.wait4 returns the resource usage of the shell and the commands it ran
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, shell=True, cwd=cwd)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    record = {'cmd': cmd, 'exitcode': proc.returncode,
+              'wall': time.perf_counter()-start,
+              'cpu': usage.ru_utime+usage.ru_stime,
+              'maxrss': usage.ru_maxrss}
+    with engine['lock']:
+        engine['history'].append(record)
+    # the command may have created or deleted files
+    clear_dir_index()
+    if record['wall'] >= 1.:
+        print("-> {0} (exit={1} wall={2:.1f}s cpu={3:.1f}s maxrss={4:.0f}MB)".format(
+              cmd, record['exitcode'], record['wall'], record['cpu'], record['maxrss']/1024.))
+    return record
+
+
+def report_cmdline_history(nmax=10):
+    "Print the command lines with the longest wall time"
+
+    history = sorted(engine['history'], key=lambda record: record['wall'], reverse=True)
+    for record in history[:nmax]:
+        if record['wall'] >= 1.:
+            print("{0:8.1f}s {1:8.1f}s {2:8.0f}MB  {3}".format(
+                  record['wall'], record['cpu'], record['maxrss']/1024., record['cmd']))
+
+
+def match_files(pattern):
+    "Return the sorted list of files matching a shell pattern"
+
+    pattern = dict2str(pattern)
+    dirname, basename = os.path.split(pattern)
+    if not any(c in basename for c in '*?['):
+        if file_exists(pattern):
+            return [pattern]
+        return []
+    listing = get_dir_listing(dirname)
+    if listing is None:
+        try:
+            with os.scandir(dirname or '.') as entries:
+                listing = [entry.name for entry in entries]
+        except FileNotFoundError:
+            return []
+    names = [name for name in listing
+             if fnmatch.fnmatchcase(name, basename)
+             and (basename.startswith('.') or not name.startswith('.'))]
+    return [os.path.join(dirname, name) for name in sorted(names)]
+
+
+def remove_files(pattern, background=False):
+    "Delete files matching a shell pattern"
+
+    # background deletion is only used for files that are not tested again
+    # by the script (e.g., restart and host tiles)
+    for fname in match_files(pattern):
+        if background is True:
+            start_deletion_thread()
+            update_dir_index(fname, False)
+            deletion['queue'].put(fname)
+        else:
+            remove_file(fname)
+
+
+def remove_file(fname):
+    "Delete a file if it exists"
+
+    try:
+        os.unlink(fname)
+    except FileNotFoundError:
+        pass
+    update_dir_index(fname, False)
+
+
+def start_deletion_thread():
+    "Start the thread that deletes files in the background"
+
+    with deletion['lock']:
+        if deletion['thread'] is None:
+            deletion['thread'] = threading.Thread(target=deletion_worker, daemon=True)
+            deletion['thread'].start()
+
+
+def deletion_worker():
+    "Delete queued files"
+
+    while True:
+        fname = deletion['queue'].get()
+        try:
+            remove_file(fname)
+        except OSError as err:
+            print("WARN: Unable to delete ",fname," - ",err)
+        deletion['queue'].task_done()
+
+
+def wait_for_deletions():
+    "Wait for background file deletions to complete"
+
+    deletion['queue'].join()
+
+
+def move_files(pattern, dest):
+    "Move files matching a shell pattern to a directory or new file name"
+
+    flist = match_files(pattern)
+    if len(flist) == 0:
+        raise ValueError('No files found to move: '+dict2str(pattern))
+    dest = dict2str(dest)
+    for fname in flist:
+        newname = dest
+        if os.path.isdir(dest):
+            newname = os.path.join(dest, os.path.basename(fname))
+        try:
+            os.replace(fname, newname)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            shutil.move(fname, newname)
+        update_dir_index(fname, False)
+        update_dir_index(newname, True)
+
+
+def link_files(pattern, dest):
+    "Create symbolic links to files matching a shell pattern"
+
+    dest = dict2str(dest)
+    for fname in match_files(pattern):
+        newname = dest
+        if os.path.isdir(dest):
+            newname = os.path.join(dest, os.path.basename(fname))
+        if not os.path.lexists(newname):
+            os.symlink(fname, newname)
+            update_dir_index(newname, True)
+
+
+def copy_file(fname, newname):
+    "Copy a file, using a hard link where possible"
+
+    fname = dict2str(fname)
+    newname = dict2str(newname)
+    remove_file(newname)
+    try:
+        os.link(fname, newname)
+    except OSError:
+        shutil.copy2(fname, newname)
+    update_dir_index(newname, True)
+
+
+def extract_tar(tname, path='.'):
+    "Extract a tar file"
+
+    # stream members in order without listing them
+    with tarfile.open(dict2str(tname), 'r|*') as tfile:
+        if hasattr(tarfile, 'fully_trusted_filter'):
+            tfile.extractall(dict2str(path), filter='fully_trusted')
+        else:
+            tfile.extractall(dict2str(path))
+    drop_dir_index(path)
+
+
+def create_tar(tname, pattern):
+    "Create a tar file from files matching a shell pattern"
+
+    # the tar file is renamed into place once complete
+    tname = dict2str(tname)
+    with tarfile.open(tname+'.tmp', 'w') as tfile:
+        for fname in match_files(pattern):
+            tfile.add(fname, arcname=os.path.basename(fname))
+    os.replace(tname+'.tmp', tname)
+    update_dir_index(tname, True)
+
+
+# The directory index holds the listings of the directories used by the current
+# phase (see refresh_dir_index), so that existence tests do not stat each file
+# on the file system.  Listings are read on first use, updated by the file
+# operations above and dropped whenever an external command has run.
+
+def refresh_dir_index(dirlist):
+    "Define the indexed directories for the current phase"
+
+    dirs = set()
+    for dirname in dirlist:
+        try:
+            dirs.add(os.path.abspath(dict2str(dirname)))
+        except KeyError:
+            pass  # directory not used by this dmode
+    with dir_index['lock']:
+        dir_index['dirs'] = dirs
+        dir_index['names'] = {}
+
+
+def get_dir_listing(dirname):
+    "Return the set of names in an indexed directory, or None if not indexed"
+
+    dirname = os.path.abspath(dirname or '.')
+    with dir_index['lock']:
+        if dirname not in dir_index['dirs']:
+            return None
+        names = dir_index['names'].get(dirname)
+    if names is None:
+        try:
+            with os.scandir(dirname) as entries:
+                names = set(entry.name for entry in entries)
+        except FileNotFoundError:
+            names = set()
+        with dir_index['lock']:
+            if dirname in dir_index['dirs']:
+                names = dir_index['names'].setdefault(dirname, names)
+    return names
+
+
+def file_exists(fname):
+    "Test if a file exists, using the directory index where possible"
+
+    dirname, basename = os.path.split(fname)
+    names = get_dir_listing(dirname)
+    if names is None:
+        return os.path.exists(fname)
+    return basename in names
+
+
+def update_dir_index(fname, exists):
+    "Record that a file has been created or deleted by the script"
+
+    dirname, basename = os.path.split(fname)
+    dirname = os.path.abspath(dirname or '.')
+    with dir_index['lock']:
+        names = dir_index['names'].get(dirname)
+        if names is not None:
+            if exists is True:
+                names.add(basename)
+            else:
+                names.discard(basename)
+
+
+def drop_dir_index(dirname):
+    "Reread the listing of a directory on next use"
+
+    dirname = os.path.abspath(dict2str(dirname) or '.')
+    with dir_index['lock']:
+        dir_index['names'].pop(dirname, None)
+
+
+def clear_dir_index():
+    "Reread all directory listings on next use"
+
+    with dir_index['lock']:
+        dir_index['names'] = {}
 
 
 def dict2str(str_template):
@@ -2291,18 +4078,29 @@ def dict2str(str_template):
     return str_template.format(**d)
 
 
-def write2file(fname, args_template, mode='a'):
+def write2file(fname, args_template, mode='a', stage=False):
     "Write arguments to namelist file"
 
+    text = args_template.format(**d)
+    if stage is True:
+        text = stage_input_paths(text)
     with open(fname, mode) as ofile:
-        ofile.write(args_template.format(**d))
+        ofile.write(text)
 
     ofile.close()
+    update_dir_index(fname, True)
 
 
 def get_fpath(fpath):
-    "Get relevant file path(s)"
-    return subprocess.getoutput(dict2str('ls -1tr '+fpath+' | tail -1'))
+    "Get the most recently modified file matching a shell pattern"
+
+    fpath = dict2str(fpath)
+    dirname, basename = os.path.split(fpath)
+    flist = [name for name in get_forcing_listing(dirname)
+             if fnmatch.fnmatchcase(name, basename)]
+    if len(flist) == 0:
+        return fpath  # reported as missing
+    return os.path.join(dirname, flist[-1])
 
 
 def check_file_exists(path):
@@ -2321,35 +4119,102 @@ def mon_2digit(imth):
     return str(cmth)
 
 
-def check_msg_in_log(exename, fname, msg):
+# error classes reported when a log file is missing its success message.  The
+# first matching class is used, so more specific errors are listed first.
+log_error_list = [ ("NaN", re.compile(rb'\bNaN\b|\bnan\b')),
+                   ("CFL", re.compile(rb'CFL')),
+                   ("out of memory", re.compile(rb'out of memory|oom-kill|oom_kill', re.IGNORECASE)),
+                   ("time limit", re.compile(rb'DUE TO TIME LIMIT|time limit', re.IGNORECASE)),
+                   ("segmentation fault", re.compile(rb'segmentation fault|SIGSEGV', re.IGNORECASE)),
+                   ("MPI abort", re.compile(rb'MPI_ABORT|MPI_Abort|mpi_abort')) ]
+
+
+def check_msg_in_log(exename, fname, msg, errfiles=None):
     "Checks if text is present in log file"
-    
-    xtest = subprocess.getoutput('grep -o --text "'+msg+'" '+fname) == msg
+
+    xtest = find_msg_in_log(fname, msg)
     if xtest is False:
-        raise ValueError("An error occured while running "+exename+".  Check "+fname+" for details")
+        errclass = "unknown error"
+        for ename in [fname]+(errfiles or []):
+            etest = classify_log_error(ename)
+            if etest != "":
+                errclass = etest
+                break
+        raise ValueError("An error occured while running "+exename+" ("+errclass+").  Check "+fname+" for details")
+
+
+def find_msg_in_log(fname, msg, blocksize=1048576):
+    "Search for text in a log file, reading backwards from the end of the file"
+
+    # success messages are written at the end of the log, so the search
+    # normally stops after reading the final block
+    if not os.path.exists(fname):
+        return False
+    bmsg = msg.encode()
+    with open(fname, 'rb') as logfile:
+        pos = logfile.seek(0, os.SEEK_END)
+        tail = b''
+        while pos > 0:
+            size = min(blocksize, pos)
+            pos = pos - size
+            logfile.seek(pos)
+            block = logfile.read(size) + tail
+            if block.find(bmsg) != -1:
+                return True
+            # keep enough text to find a message split across blocks
+            tail = block[:len(bmsg)-1]
+    return False
+
+
+def classify_log_error(fname, tailsize=1048576):
+    "Return the class of error reported at the end of a log file"
+
+    if not os.path.exists(fname):
+        return ""
+    with open(fname, 'rb') as logfile:
+        pos = logfile.seek(0, os.SEEK_END)
+        logfile.seek(max(0, pos-tailsize))
+        block = logfile.read()
+    for errclass, pattern in log_error_list:
+        if pattern.search(block):
+            return errclass
+    return ""
 
 
 def check_var_in_file(fname, vname):
     "Checks if a variable exists in a netcdf file"
-    
-    file_test = subprocess.getoutput('ncdump -c '+fname+' | grep -o --text '+vname+' | head -1') == vname
+
+    # vname can be a dimension, variable or attribute name.  A leading ':' only
+    # tests attribute names (e.g., ':version' for CCAM output)
+    header = read_nc_header(fname)
+    attnames = set(header['atts'])
+    for var in header['vars'].values():
+        attnames.update(var['atts'])
+    if vname.startswith(':'):
+        return vname[1:] in attnames
+    file_test = (vname in header['vars']) or (vname in header['dims']) or (vname in attnames)
     return file_test
 
 
 def check_attribute_in_file(fname, vname, aname, vdata):
     "Checks if attribute in file matches required value"
 
-    file_test = subprocess.getoutput('ncdump -c '+fname+' | grep '+vname+' | grep '+aname+' | grep -o --text '+vdata) == vdata
+    header = read_nc_header(fname)
+    if not vname in header['vars']:
+        return False
+    attdata = header['vars'][vname]['atts'].get(aname, "")
+    file_test = vdata in str(attdata)
     return file_test
 
 
 def check_timestep_in_file(fname):
     "Checks the time-step in output file"
-    
-    timestep = subprocess.getoutput('ncdump -c '+fname+' | grep time | tail -1 | cut -d= -f2 | cut -d, -f1')
-    if timestep == 0:
-        timestep = subprocess.getoutput('ncdump -c '+fname+' | grep time | tail -1 | cut -d= -f2 | cut -d, -f2')
-    return timestep
+
+    # only the first time value is read from the file
+    timestep = read_nc_first_time(fname)
+    if timestep == int(timestep):
+        timestep = int(timestep)
+    return str(timestep)
 
 
 def check_calendar_in_file(cname, calendar_found):
@@ -2384,15 +4249,29 @@ def check_calendar_in_file(cname, calendar_found):
 def check_starttime_in_file(fname):
     "Check start time in input file"
 
-    starttime = int(subprocess.getoutput('ncdump -c '+fname+' | grep time | grep units | head -1 | cut -d= -f2 | cut -d" " -f5 | cut -d: -f1'))
+    # hour of the reference date in time units (e.g., minutes since 2000-01-01 00:00:00)
+    header = read_nc_header(fname)
+    units = ""
+    if 'time' in header['vars']:
+        units = str(header['vars']['time']['atts'].get('units', ""))
+    unitlist = units.split()
+    if len(unitlist) < 3:
+        raise ValueError('Cannot locate time units in '+fname)
+    starttime = 0
+    if len(unitlist) > 3:
+        starttime = int(unitlist[3].split(':')[0])
     return starttime
 
 
 def get_grid_properties_in_file(fname):
     "Obtain grid information from file"
 
-    host_inv_schmidt = float(subprocess.getoutput('ncdump -c '+fname+' | grep schmidt | cut -d"=" -f2 | cut -d";" -f1 | sed "s/f//g" | sed "s/ //g"'))
-    host_gridsize = float(subprocess.getoutput('ncdump -c '+fname+' | grep il_g | cut -d"=" -f2 | cut -d";" -f1 | sed "s/ //g"'))
+    header = read_nc_header(fname)
+    for aname in ['schmidt', 'il_g']:
+        if not aname in header['atts']:
+            raise ValueError('Cannot locate '+aname+' in '+fname)
+    host_inv_schmidt = float(header['atts']['schmidt'])
+    host_gridsize = float(header['atts']['il_g'])
     return host_inv_schmidt, host_gridsize
 
 
@@ -2424,11 +4303,788 @@ def calc_drs_host(fname):
 def check_attributevalue_in_file(fname, attname):
     "Return value of attribute"
 
-    attdata = subprocess.getoutput('ncdump -c '+fname+' | grep '+attname+' | cut -d\\" -f2')
+    header = read_nc_header(fname)
+    attdata = ""
+    if attname in header['atts']:
+        attdata = str(header['atts'][attname])
     print(attdata)
     return attdata
 
 
+#===============================================================================
+# NetCDF header reader
+#===============================================================================
+
+# Headers are parsed once and memoized on path, modification time and size.
+# Coordinate data is never read, with the exception of the first time value
+# that is requested for the pcc2hist namelists.
+
+nc_header_cache = {}
+
+nc_type_dict = { 1:('b', 1), 2:('c', 1), 3:('h', 2), 4:('i', 4), 5:('f', 4), 6:('d', 8),
+                 7:('B', 1), 8:('H', 2), 9:('I', 4), 10:('q', 8), 11:('Q', 8) }
+
+
+def read_nc_header(fname):
+    "Read the header of a netcdf file"
+
+    fstat = os.stat(fname)
+    key = (os.path.realpath(fname), fstat.st_mtime_ns, fstat.st_size)
+    if key in nc_header_cache:
+        return nc_header_cache[key]
+
+    # facts recorded by a previous job
+    header = lookup_metadata_catalog(key[0], fstat)
+
+    if header is None:
+        with open(fname, 'rb') as ncfile:
+            magic = ncfile.read(4)
+        if magic[0:3] == b'CDF':
+            header = read_nc_classic_header(fname)
+        elif netCDF4 is not None:
+            header = read_nc_netcdf4_header(fname)
+        else:
+            header = read_nc_ncdump_header(fname)
+        store_metadata_catalog(key[0], fstat, header)
+
+    nc_header_cache[key] = header
+    return header
+
+
+def read_nc_first_time(fname):
+    "Read the first value of the time coordinate"
+
+    header = read_nc_header(fname)
+    if header['time0'] is None:
+        if not 'time' in header['vars']:
+            raise ValueError('Cannot locate time in '+fname)
+        if header['format'] in ['CDF1', 'CDF2', 'CDF5']:
+            var = header['vars']['time']
+            code, size = nc_type_dict[var['type']]
+            with open(fname, 'rb') as ncfile:
+                ncfile.seek(var['begin'])
+                header['time0'] = float(struct.unpack('>'+code, ncfile.read(size))[0])
+        elif netCDF4 is not None:
+            with netCDF4.Dataset(fname) as ncfile:
+                header['time0'] = float(ncfile.variables['time'][0])
+        else:
+            timedata = subprocess.getoutput('ncdump -v time '+fname).split('data:')[-1]
+            header['time0'] = float(timedata.split('=')[1].split(',')[0].split(';')[0])
+        store_metadata_catalog(os.path.realpath(fname), os.stat(fname), header)
+    return header['time0']
+
+
+#===============================================================================
+# Metadata catalog
+#===============================================================================
+
+# Header facts are stored in {hdir}/metadata.db so that resubmitted jobs do not
+# parse the same host, restart and history files again.  Entries are matched on
+# size and modification time, or on a fingerprint of the first block of the file
+# when only the modification time has changed (e.g., a copy of the file).
+
+metadata_catalog = {'conn': None, 'failed': False}
+metadata_lock = threading.Lock()
+
+
+def open_metadata_catalog():
+    "Open the metadata catalog in hdir"
+
+    if metadata_catalog['failed'] or d.get('metacatalog', "off") != "on":
+        return None
+    if metadata_catalog['conn'] is None:
+        try:
+            conn = sqlite3.connect(dict2str('{hdir}/metadata.db'), timeout=60., check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS header (path TEXT PRIMARY KEY, size INTEGER, '
+                         'mtime INTEGER, fingerprint TEXT, header TEXT)')
+            conn.commit()
+            metadata_catalog['conn'] = conn
+        except sqlite3.Error as err:
+            print("WARN: Unable to open metadata catalog - ",err)
+            metadata_catalog['failed'] = True
+    return metadata_catalog['conn']
+
+
+def calc_file_fingerprint(fname, blocksize=65536):
+    "Calculate a content fingerprint from the size and first block of a file"
+
+    with open(fname, 'rb') as ifile:
+        digest = hashlib.sha1(ifile.read(blocksize)).hexdigest()
+    return str(os.stat(fname).st_size)+':'+digest
+
+
+def lookup_metadata_catalog(path, fstat):
+    "Return header facts for path from the metadata catalog"
+
+    with metadata_lock:
+        conn = open_metadata_catalog()
+        if conn is None:
+            return None
+        try:
+            row = conn.execute('SELECT size, mtime, fingerprint, header FROM header WHERE path=?',
+                               (path,)).fetchone()
+            if (row is None) or (row[0] != fstat.st_size):
+                return None
+            if row[1] != fstat.st_mtime_ns:
+                if calc_file_fingerprint(path) != row[2]:
+                    return None
+                conn.execute('UPDATE header SET mtime=? WHERE path=?', (fstat.st_mtime_ns, path))
+                conn.commit()
+            return json.loads(row[3])
+        except sqlite3.Error as err:
+            print("WARN: Unable to read metadata catalog - ",err)
+            metadata_catalog['failed'] = True
+    return None
+
+
+def store_metadata_catalog(path, fstat, header):
+    "Record header facts for path in the metadata catalog"
+
+    with metadata_lock:
+        conn = open_metadata_catalog()
+        if conn is None:
+            return
+        try:
+            conn.execute('INSERT OR REPLACE INTO header VALUES (?, ?, ?, ?, ?)',
+                         (path, fstat.st_size, fstat.st_mtime_ns, calc_file_fingerprint(path),
+                          json.dumps(header)))
+            conn.commit()
+        except sqlite3.Error as err:
+            print("WARN: Unable to update metadata catalog - ",err)
+            metadata_catalog['failed'] = True
+
+
+def read_nc_classic_header(fname):
+    "Parse the header of a netcdf classic, 64-bit offset or CDF-5 file"
+
+    header = {'dims': {}, 'unlimited': None, 'vars': {}, 'atts': {}, 'time0': None}
+
+    with open(fname, 'rb') as ncfile:
+
+        version = ncfile.read(4)[3]
+        header['format'] = 'CDF'+str(version)
+        # CDF-5 uses 64-bit counts.  64-bit offset and CDF-5 use 64-bit offsets
+        nfmt = '>q' if version == 5 else '>i'
+        ofmt = '>i' if version == 1 else '>q'
+
+        def read_fmt(fmt):
+            return struct.unpack(fmt, ncfile.read(struct.calcsize(fmt)))[0]
+
+        def read_name():
+            nlen = read_fmt(nfmt)
+            name = ncfile.read(nlen).decode('utf-8', 'replace')
+            ncfile.read(-nlen % 4)
+            return name
+
+        def read_atts():
+            atts = {}
+            read_fmt('>i')
+            for _ in range(read_fmt(nfmt)):
+                aname = read_name()
+                atype = read_fmt('>i')
+                nelems = read_fmt(nfmt)
+                code, size = nc_type_dict[atype]
+                raw = ncfile.read(nelems*size)
+                ncfile.read(-(nelems*size) % 4)
+                if atype == 2:
+                    atts[aname] = raw.decode('utf-8', 'replace').rstrip('\x00')
+                else:
+                    values = struct.unpack('>'+str(nelems)+code, raw)
+                    atts[aname] = values[0] if nelems == 1 else list(values)
+            return atts
+
+        read_fmt(nfmt) # numrecs
+
+        dimnames = []
+        read_fmt('>i')
+        for _ in range(read_fmt(nfmt)):
+            dname = read_name()
+            dlen = read_fmt(nfmt)
+            if dlen == 0:
+                header['unlimited'] = dname
+            header['dims'][dname] = dlen
+            dimnames.append(dname)
+
+        header['atts'] = read_atts()
+
+        read_fmt('>i')
+        for _ in range(read_fmt(nfmt)):
+            vname = read_name()
+            dimids = [read_fmt(nfmt) for _ in range(read_fmt(nfmt))]
+            atts = read_atts()
+            vtype = read_fmt('>i')
+            read_fmt(nfmt) # vsize
+            begin = read_fmt(ofmt)
+            header['vars'][vname] = {'dims': [dimnames[i] for i in dimids], 'atts': atts,
+                                     'type': vtype, 'begin': begin}
+
+    return header
+
+
+def read_nc_netcdf4_header(fname):
+    "Read the header of a netcdf4/HDF5 file using the netCDF4 library"
+
+    header = {'dims': {}, 'unlimited': None, 'vars': {}, 'atts': {}, 'time0': None}
+
+    def att_value(value):
+        if hasattr(value, 'tolist'):
+            value = value.tolist()
+        if isinstance(value, list) and len(value) == 1:
+            value = value[0]
+        return value
+
+    with netCDF4.Dataset(fname) as ncfile:
+        header['format'] = ncfile.data_model
+        for dname, dim in ncfile.dimensions.items():
+            header['dims'][dname] = len(dim)
+            if dim.isunlimited():
+                header['unlimited'] = dname
+        for aname in ncfile.ncattrs():
+            header['atts'][aname] = att_value(ncfile.getncattr(aname))
+        for vname, var in ncfile.variables.items():
+            atts = {}
+            for aname in var.ncattrs():
+                atts[aname] = att_value(var.getncattr(aname))
+            header['vars'][vname] = {'dims': list(var.dimensions), 'atts': atts}
+
+    return header
+
+
+def read_nc_ncdump_header(fname):
+    "Read the header of a netcdf4/HDF5 file using ncdump -h"
+
+    header = {'format': 'ncdump', 'dims': {}, 'unlimited': None, 'vars': {}, 'atts': {}, 'time0': None}
+
+    def att_value(text):
+        text = text.strip()
+        if text.startswith('"'):
+            value = "".join(re.findall(r'"((?:[^"\\]|\\.)*)"', text))
+            return value.replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
+        values = []
+        for item in text.split(','):
+            item = item.strip().rstrip('bBsSfFlLuU')
+            try:
+                values.append(int(item))
+            except ValueError:
+                try:
+                    values.append(float(item))
+                except ValueError:
+                    values.append(item)
+        return values[0] if len(values) == 1 else values
+
+    section = ""
+    statement = ""
+    for line in subprocess.getoutput('ncdump -h '+fname).splitlines():
+        if line.strip() in ['dimensions:', 'variables:']:
+            section = line.strip()
+            continue
+        if line.strip().startswith('// global attributes:'):
+            section = 'variables:'
+            continue
+        if section == "":
+            continue
+        # combine statements that are split over several lines
+        statement = statement + " " + line.strip()
+        if not re.search(r';\s*(//.*)?$', statement):
+            continue
+        statement, text = "", statement.strip()
+        if section == 'dimensions:':
+            match = re.match(r'(\S+)\s*=\s*(UNLIMITED|\d+)\s*;(?:\s*//\s*\((\d+) currently\))?', text)
+            if match:
+                if match.group(2) == 'UNLIMITED':
+                    header['unlimited'] = match.group(1)
+                    header['dims'][match.group(1)] = int(match.group(3) or 0)
+                else:
+                    header['dims'][match.group(1)] = int(match.group(2))
+            continue
+        match = re.match(r'(?:\w+\s+)?([^\s:]*):([^\s=]+)\s*=\s*(.*);$', text)
+        if match:
+            vname, aname, value = match.groups()
+            if vname == "":
+                header['atts'][aname] = att_value(value)
+            elif vname in header['vars']:
+                header['vars'][vname]['atts'][aname] = att_value(value)
+            continue
+        match = re.match(r'\w+\s+([^\s(]+)\s*(?:\((.*)\))?\s*;$', text)
+        if match:
+            dims = []
+            if match.group(2):
+                dims = [dname.strip() for dname in match.group(2).split(',')]
+            header['vars'][match.group(1)] = {'dims': dims, 'atts': {}}
+
+    return header
+
+
+#===============================================================================
+# Shared surface cache
+#===============================================================================
+
+# Surface files (topout, veg, bath, casa and aero) can be shared between
+# experiments on the same domain with --surfcache.  Entries are stored in
+# {surfcache}/{domain}/<product>.<key>, where the key is a hash of the
+# namelists, the datasets they reference (path, size and modification time),
+# the executables and the content of input files from the experiment.  Files
+# are copied in both directions (not hard linked), so that the read-only
+# entries never share an inode with the files of an experiment.  A lock file
+# for each entry ensures that only one job creates a given entry.
+
+# file digests memoized on path, modification time and size
+digest_cache = {}
+digest_lock = threading.Lock()
+
+@contextlib.contextmanager
+def surface_cache_entry(product, textlist, exelist, filelist=None):
+    "Lock and return the shared surface cache entry for a product"
+
+    if d.get('surfcache', "none") == "none":
+        yield None
+        return
+    cdir = calc_surface_cache_entry(product, textlist, exelist, filelist)
+    os.makedirs(os.path.dirname(cdir), exist_ok=True)
+    with open(cdir+'.lock', 'w') as lfile:
+        fcntl.flock(lfile, fcntl.LOCK_EX)
+        try:
+            yield cdir
+        finally:
+            fcntl.flock(lfile, fcntl.LOCK_UN)
+
+
+def calc_surface_cache_entry(product, textlist, exelist, filelist):
+    "Return the shared surface cache directory for a product and its inputs"
+
+    key = calc_surface_key(product, textlist, exelist, filelist)
+    return os.path.join(d['surfcache'], d['domain'], product+'.'+key)
+
+
+def calc_surface_key(product, textlist, exelist, filelist=None, stats=True):
+    "Return a hash of the inputs of a surface product (stats=False for paths only)"
+
+    hdir = d['hdir']
+    key = hashlib.sha1(product.encode())
+    for text in textlist:
+        # files in the experiment directory are hashed by content (filelist)
+        text = dict2str(text)
+        if stats is True:
+            for path in re.findall(r'/[^\s"\',]+', text):
+                if not path.startswith(hdir):
+                    key.update(stat_signature(path).encode())
+        key.update(text.replace(hdir, '{hdir}').encode())
+    if stats is True:
+        for exe in exelist:
+            path = shutil.which(d[exe]) or d[exe]
+            key.update((exe+stat_signature(path)).encode())
+    for fname in filelist or []:
+        fname = dict2str(fname)
+        if os.path.exists(fname):
+            key.update(calc_file_digest(fname).encode())
+        else:
+            key.update(b'missing')
+    return key.hexdigest()
+
+
+def stat_signature(path):
+    "Return the path, size and modification time of a file as a string"
+
+    try:
+        fstat = os.stat(path)
+    except OSError:
+        return path+':missing'
+    return '{0}:{1}:{2}'.format(path, fstat.st_size, fstat.st_mtime_ns)
+
+
+def calc_file_digest(fname, blocksize=1048576):
+    "Calculate the SHA-1 digest of the content of a file"
+
+    fstat = os.stat(fname)
+    memo = (os.path.realpath(fname), fstat.st_mtime_ns, fstat.st_size)
+    with digest_lock:
+        if memo in digest_cache:
+            return digest_cache[memo]
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as ifile:
+        for block in iter(lambda: ifile.read(blocksize), b''):
+            digest.update(block)
+    with digest_lock:
+        digest_cache[memo] = digest.hexdigest()
+    return digest.hexdigest()
+
+
+def fetch_surface_cache(cdir, dest):
+    "Link the files of a shared surface cache entry into dest"
+
+    if (cdir is None) or not os.path.isdir(cdir):
+        return False
+    print("-> Using shared surface cache ",cdir)
+    dest = dict2str(dest)
+    # entries are read-only, so the files are copied rather than linked
+    for name in sorted(os.listdir(cdir)):
+        newname = os.path.join(dest, name)
+        remove_file(newname)
+        shutil.copyfile(os.path.join(cdir, name), newname)
+        update_dir_index(newname, True)
+    return True
+
+
+def store_surface_cache(cdir, patterns):
+    "Store files matching shell patterns as a shared surface cache entry"
+
+    if cdir is None:
+        return
+    # the entry is renamed into place once complete
+    tmpdir = cdir+'.tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+    # entries are copies, so that making them read-only does not change the
+    # files of the experiment
+    for pattern in patterns:
+        for fname in match_files(pattern):
+            newname = os.path.join(tmpdir, os.path.basename(fname))
+            shutil.copy2(fname, newname)
+            os.chmod(newname, 0o444)
+    os.rename(tmpdir, cdir)
+
+
+#===============================================================================
+# Node-local staging cache
+#===============================================================================
+
+# Read-only input files in stdat and insdir (eigenv, oxidants, ozone, GHG,
+# solar, phenology and the vegin datasets) can be copied to node-local disk
+# or tmpfs with --stagecache.  Namelists written with stage=True then refer
+# to the copies.  Each file is stored in its own entry directory, whose
+# modification time records the last use, and the least recently used
+# entries are removed to keep the cache within --stagesize GB.  A job holds a
+# shared lock on the stage.pin file of each entry that it has used until it
+# exits, so that entries referenced by the namelists of a running job (also
+# of other jobs on the same node) are never removed.  Files are not staged
+# when the budget cannot be met without removing such entries.  The copies
+# only exist on the node that runs this script, so files are only staged
+# when the job fits on one node (nproc <= nnode).
+staged_pins = {}
+
+def stage_input_paths(text):
+    "Replace quoted stdat and insdir file names in text with staged copies"
+
+    if d.get('stagecache', "none") == "none":
+        return text
+    return re.sub(r"(['\"])([^'\"\n]+)\1", lambda m: m.group(1)+stage_input_file(m.group(2))+m.group(1), text)
+
+
+def stage_input_file(fname):
+    "Return a staged copy of a read-only input file, or fname if it is not staged"
+
+    if d.get('stagecache', "none") == "none":
+        return fname
+    if d['nproc'] > d['nnode']:
+        return fname  # the ranks on other nodes cannot read the copies
+    srcdirs = [os.path.join(os.path.realpath(d[key]), '') for key in ['stdat', 'insdir'] if d.get(key)]
+    if not any(os.path.realpath(fname).startswith(srcdir) for srcdir in srcdirs):
+        return fname
+    try:
+        fstat = os.stat(fname)
+    except OSError:
+        return fname
+    if not os.path.isfile(fname):
+        return fname
+
+    key = hashlib.sha1(os.path.realpath(fname).encode()).hexdigest()[:16]
+    edir = os.path.join(d['stagecache'], 'stage.'+key)
+    newname = os.path.join(edir, os.path.basename(fname))
+    try:
+        os.makedirs(d['stagecache'], exist_ok=True)
+        with open(os.path.join(d['stagecache'], 'stage.lock'), 'w') as lfile:
+            fcntl.flock(lfile, fcntl.LOCK_EX)
+            try:
+                if not check_staged_file(newname, fstat):
+                    if fstat.st_size > d['stagesize']*1.e9:
+                        return fname
+                    if not evict_staged_files(fstat.st_size):
+                        return fname
+                    # an outdated entry may still be in use by a job
+                    if not remove_staged_entry(edir):
+                        return fname
+                    os.makedirs(edir)
+                    shutil.copy2(fname, newname+'.tmp')
+                    os.rename(newname+'.tmp', newname)
+                pin_staged_entry(edir)
+                os.utime(edir)
+            finally:
+                fcntl.flock(lfile, fcntl.LOCK_UN)
+    except OSError as err:
+        print("WARN: Unable to stage ",fname," - ",err)
+        remove_staged_entry(edir)
+        return fname
+    return newname
+
+
+def check_staged_file(newname, fstat):
+    "Check if a staged copy matches the size and modification time of the original"
+
+    try:
+        nstat = os.stat(newname)
+    except OSError:
+        return False
+    return (nstat.st_size == fstat.st_size) and (int(nstat.st_mtime) == int(fstat.st_mtime))
+
+
+def pin_staged_entry(edir):
+    "Hold a shared lock on a staging cache entry until the job exits"
+
+    pfile = staged_pins.get(edir)
+    if (pfile is not None) and os.path.exists(os.path.join(edir, 'stage.pin')):
+        return
+    if pfile is not None:
+        pfile.close()  # the entry was replaced
+    pfile = open(os.path.join(edir, 'stage.pin'), 'a')
+    fcntl.flock(pfile, fcntl.LOCK_SH)
+    staged_pins[edir] = pfile
+
+
+def evict_staged_files(size):
+    "Remove least recently used staging cache entries to make room for size bytes, and return True if possible"
+
+    entries = []
+    total = 0
+    with os.scandir(d['stagecache']) as it:
+        for entry in it:
+            if entry.name.startswith('stage.') and entry.is_dir(follow_symlinks=False):
+                esize = sum(os.path.getsize(os.path.join(entry.path, name)) for name in os.listdir(entry.path))
+                entries.append((entry.stat().st_mtime, esize, entry.path))
+                total = total + esize
+    for _, esize, path in sorted(entries):
+        if total + size <= d['stagesize']*1.e9:
+            break
+        if not remove_staged_entry(path):
+            continue
+        total = total - esize
+    return total + size <= d['stagesize']*1.e9
+
+
+def remove_staged_entry(edir):
+    "Remove a staging cache entry, and return False if it is in use by a job"
+
+    # entries in use by a job (including this one) are kept
+    try:
+        with open(os.path.join(edir, 'stage.pin'), 'a') as pfile:
+            fcntl.flock(pfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            shutil.rmtree(edir, ignore_errors=True)
+    except BlockingIOError:
+        return False
+    except OSError:
+        shutil.rmtree(edir, ignore_errors=True)
+    return True
+
+
+#===============================================================================
+# Forcing file resolver
+#===============================================================================
+
+# Ozone, GHG, solar and aerosol emission files only depend on the radiation
+# year.  They are resolved for all remaining years of the run when the run
+# starts, so that missing files are reported before any compute is spent.
+# Directories in stdat are listed once and the listing is sorted by
+# modification time to match the previous 'ls -1tr | tail -1' search.
+
+def resolve_forcing_files():
+    "Resolve the forcing files for each remaining radiation year of the run"
+
+    settings = dict(d.current())
+    with d.using(settings):
+        read_yearqm()
+        if d['rad_year_input'] == 0:
+            yearlist = range(d['iyr'], d['iye']+1)
+        else:
+            yearlist = [d['rad_year_input']]
+
+    missing = {}
+    for year in yearlist:
+        # the historical period check in prep_iofiles reports later years
+        if d['rcp'] == "historic":
+            if ((d['cmip'] == "cmip5") and (year >= 2005)) or ((d['cmip'] == "cmip6") and (year >= 2015)):
+                continue
+        settings['rad_year'] = year
+        settings['ddyear'] = int(int(year/10)*10)
+        settings['deyear'] = int(settings['ddyear'] + 9)
+        with d.using(settings):
+            fdict = resolve_forcing_year()
+        forcing['table'][year] = fdict
+        for fname in find_missing_forcing(fdict):
+            missing.setdefault(fname, []).append(year)
+
+    if len(missing) > 0:
+        for fname in sorted(missing):
+            yearlist = missing[fname]
+            if len(yearlist) == 1:
+                print("ERROR: Missing forcing file for year {0}: {1}".format(yearlist[0], fname))
+            else:
+                print("ERROR: Missing forcing file for years {0}-{1}: {2}".format(yearlist[0], yearlist[-1], fname))
+        raise ValueError("Forcing files are missing for the requested simulation years")
+
+
+def resolve_forcing_year():
+    "Return the forcing file settings for the current radiation year"
+
+    # settings are resolved in a copy so that the active settings are unchanged
+    settings = dict(d.current())
+    with d.using(settings):
+        if d['simulation_test'] is True:
+            set_ozone_file()
+            set_ghg_files()
+        if (d['preprocess_test'] is True) and (d['aero'] == "prognostic"):
+            set_aerosol_files()
+    return {key: settings[key] for key in forcing_key_list+['amipo3', 'rcplabel']
+            if key in settings}
+
+
+def get_forcing_files():
+    "Return the forcing file settings for the current radiation year"
+
+    fdict = forcing['table'].get(d['rad_year'])
+    if fdict is None:
+        fdict = resolve_forcing_year()
+        for fname in find_missing_forcing(fdict):
+            raise ValueError('File not found: '+fname)
+        forcing['table'][d['rad_year']] = fdict
+    return fdict
+
+
+def find_missing_forcing(fdict):
+    "Return the forcing files in fdict that cannot be found"
+
+    missing = []
+    for key in forcing_key_list:
+        fname = fdict.get(key, "")
+        if fname == "":
+            continue
+        dirname, basename = os.path.split(fname)
+        if basename not in get_forcing_listing(dirname):
+            missing.append(fname)
+    return missing
+
+
+def get_forcing_listing(dirname):
+    "Return the names in a forcing directory, sorted by modification time"
+
+    with forcing['lock']:
+        names = forcing['dirs'].get(dirname)
+    if names is None:
+        entries = []
+        try:
+            with os.scandir(dirname) as it:
+                for entry in it:
+                    try:
+                        entries.append((entry.stat().st_mtime_ns, entry.name))
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
+        names = [name for _, name in sorted(entries)]
+        with forcing['lock']:
+            forcing['dirs'][dirname] = names
+    return names
+
+
+#===============================================================================
+# Forcing file slices
+#===============================================================================
+
+# GHG, solar, ozone and SST files cover decades to centuries.  With
+# --slicecache the records for the current year and the neighbouring years
+# (used to interpolate at the start and end of the year) are copied to a
+# file in {slicecache}, and the namelist refers to the slice.  Slices are
+# named after the file, a hash of its path and the year, and they are
+# created with ncks or the netCDF4 module.  The original file is used if
+# neither is available or the file has no time dimension.
+
+slice_key_list = ['ozone', 'co2file', 'ch4file', 'n2ofile', 'cfc11file', 'cfc12file',
+                  'cfc113file', 'hcfc22file', 'solarfile']
+
+def slice_forcing_files(fdict, year):
+    "Return fdict with the radiation forcing files replaced by slices for year"
+
+    if d.get('slicecache', "none") == "none":
+        return fdict
+    keys = [key for key in slice_key_list if fdict.get(key, "") != ""]
+    results = wait_tasks([launch_task(slice_forcing_file, fdict[key], year) for key in keys])
+    sliced = dict(fdict)
+    sliced.update(zip(keys, results))
+    return sliced
+
+
+def slice_forcing_file(fname, year):
+    "Return a file with the records of fname for year-1 to year+1, or fname"
+
+    if d.get('slicecache', "none") == "none":
+        return fname
+    try:
+        header = read_nc_header(fname)
+    except (OSError, ValueError, KeyError, struct.error):
+        return fname  # not a netcdf file (e.g., cmip5 GHG)
+    if not 'time' in header['dims']:
+        return fname
+
+    name = os.path.basename(fname)
+    if name.endswith('.nc'):
+        name = name[:-3]
+    key = hashlib.sha1(os.path.realpath(fname).encode()).hexdigest()[:16]
+    newname = os.path.join(dict2str('{slicecache}'), name+'.'+key+'.'+str(year)+'.nc')
+    if os.path.exists(newname) and (os.path.getmtime(newname) >= os.path.getmtime(fname)):
+        return newname
+
+    # the slice is renamed into place once complete
+    tmpname = newname+'.'+str(os.getpid())+'.tmp'
+    try:
+        os.makedirs(os.path.dirname(newname), exist_ok=True)
+        if shutil.which('ncks') is not None:
+            run_cmdline('ncks -O -d time,{0}-01-01,"{1}-12-31 23:59:59" {2} {3}'.format(year-1, year+1, fname, tmpname))
+        elif netCDF4 is not None:
+            copy_nc_time_slice(fname, tmpname, year-1, year+1)
+        else:
+            return fname
+        os.replace(tmpname, newname)
+    except (OSError, ValueError, RuntimeError) as err:
+        print("WARN: Unable to slice ",fname," - ",err)
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        return fname
+    print("-> Created forcing slice ",newname)
+    return newname
+
+
+def copy_nc_time_slice(fname, newname, syear, eyear):
+    "Copy the records of years syear to eyear of a netcdf file using the netCDF4 module"
+
+    with netCDF4.Dataset(fname) as src:
+        src.set_auto_maskandscale(False)
+        tvar = src.variables['time']
+        dates = netCDF4.num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard'))
+        index = [i for i, date in enumerate(dates) if syear <= date.year <= eyear]
+        if len(index) == 0:
+            raise ValueError('No records for '+str(syear)+'-'+str(eyear))
+        tslice = slice(index[0], index[-1]+1)
+        with netCDF4.Dataset(newname, 'w', format=src.data_model) as dst:
+            dst.set_auto_maskandscale(False)
+            dst.setncatts({aname: src.getncattr(aname) for aname in src.ncattrs()})
+            for dname, dim in src.dimensions.items():
+                if dim.isunlimited():
+                    dst.createDimension(dname, None)
+                elif dname == 'time':
+                    dst.createDimension(dname, len(index))
+                else:
+                    dst.createDimension(dname, len(dim))
+            for vname, var in src.variables.items():
+                nvar = dst.createVariable(vname, var.datatype, var.dimensions,
+                                          fill_value=getattr(var, '_FillValue', None))
+                nvar.setncatts({aname: var.getncattr(aname) for aname in var.ncattrs()
+                                if aname != '_FillValue'})
+                if 'time' in var.dimensions:
+                    key = [slice(None)]*len(var.dimensions)
+                    key[var.dimensions.index('time')] = tslice
+                    nvar[:] = var[tuple(key)]
+                else:
+                    nvar[...] = var[...]
+
+
 #===============================================================================
 # Namelist templates
 #===============================================================================
@@ -2664,7 +5320,7 @@ def input_template_1():
      oxidantfile='{stdat}/oxidants.nc'
      ofile=      '{ofile}'
      restfile=   'Rest{name}.{iyr}{imth_2digit}'
-     sstfile=    '{sstdir}/{sstfile}'
+     sstfile=    '{sstinput}'
      casafile=   '{vegin}/casa{domain}'
      phenfile=   '{stdat}/modis_phenology_csiro.nc'
      surf_00    ='{bcsoilfile}'
@@ -2896,15 +5552,15 @@ def input_template_4():
     """
 
 
-def cc_template_all():
+def cc_template_all(cwd='.'):
     "First part of template for 'cc.nml' namelist file"
 
     d['use_depth'] = 'F'
-    fname = dict2str('{histfile}.000000')
+    fname = os.path.join(cwd, dict2str('{histfile}.000000'))
     if check_var_in_file(fname,"thetao") is True:
         d['use_depth'] = 'T'
 	
-    d['ktc_local'] = check_timestep_in_file(dict2str('{histfile}.000000'))
+    d['ktc_local'] = check_timestep_in_file(os.path.join(cwd, dict2str('{histfile}.000000')))
         
     template = """\
     &input
@@ -2933,12 +5589,12 @@ def cc_template_all():
     return template
 
 
-def cc_template_ctm():
+def cc_template_ctm(cwd='.'):
     "pcc2hist namelist for CTM output"
 
     d['hnames'] = '"land_mask","vegt","soilt","lai","zolnd","zs","sigmf","tscr_ave","temp","u","v","omega","mixr","qlg","qfg","ps","rnd","rnc","pblh","fg","eg","taux","tauy","cld","qgscrn","tsu","wb1_ave","wb2_ave","wb3_ave","wb4_ave","wb5_ave","wb6_ave","tgg1","tgg2","tgg3","tgg4","tgg5","tgg6","ustar","cbas_ave","ctop_ave","u10"'
 
-    fname = dict2str('{histfile}.000000')
+    fname = os.path.join(cwd, dict2str('{histfile}.000000'))
     if check_var_in_file(fname,"rsmin") is True:
         d['hnames'] = dict2str('{hnames},"rsmin"')
     else:
@@ -2969,10 +5625,10 @@ def cc_template_ctm():
     return template
 
 
-def cc_template_latlon():
+def cc_template_latlon(cwd='.'):
     "pcc2hist namelist for high-frequency output"
 
-    d['ktc_local'] = check_timestep_in_file(dict2str('freq.{histfile}.000000'))
+    d['ktc_local'] = check_timestep_in_file(os.path.join(cwd, dict2str('freq.{histfile}.000000')))
 
     template = """\
     &input
@@ -2994,10 +5650,11 @@ def cc_template_latlon():
     return template
 
 
-def cc_template_shep():
+def cc_template_shep(cwd='.'):
     "pcc2hist namelist for high-frequency output"
 
-    d['ktc_local'] = check_timestep_in_file(dict2str('freq.{histfile}.000000'))
+    fname = os.path.join(cwd, dict2str('freq.{histfile}.000000'))
+    d['ktc_local'] = check_timestep_in_file(fname)
 
     d['hnames'] = "vegt","soilt","tas","pr","evspsbl","huss","ps","psl","uas","vas","rsds","rlds","ts","prsn","mrros","mrro","snm","rsus","rlus","hfls","hfss","zmla","CAPE","CIN","LI","orog","sftlf","ua","va","ta","hus","zg","wa","helicity"
     if check_var_in_file(fname,"sint_ave") is True:
@@ -3026,12 +5683,12 @@ def cc_template_shep():
 
     return template
 
-def cc_template_cordex():
+def cc_template_cordex(cwd='.'):
     "pcc2hist namelist for cordex output"
 
     d['hnames'] = '"tas","tasmax","tasmin","pr","ps","psl","huss","hurs","sfcWind","sfcWindmax","clt","sund","rsds","rsdsdir","rlds","hfls","hfss","rsus","rlus","evspsbl","evspsblpot","mrfso","mrros","mrro","mrso","snw","snm","prhmax","prc","rlut","rsdt","rsut","uas","vas","tauu","tauv","ts","zmla","prw","clwvi","clivi","ua1000","va1000","ta1000","zg1000","hus1000","wa1000","ua925","va925","ta925","zg925","hus925","wa925","ua850","va850","ta850","zg850","hus850","wa850","ua700","va700","ta700","zg700","hus700","wa700","ua600","va600","ta600","zg600","hus600","wa600","ua500","va500","ta500","zg500","hus500","wa500","ua400","va400","ta400","zg400","hus400","wa400","ua300","va300","ta300","zg300","hus300","wa300","ua250","va250","ta250","zg250","hus250","wa250","ua200","va200","ta200","zg200","hus200","wa200","clh","clm","cll","snc","snd","siconca","prsn","orog","sftlf","ua50m","va50m","ta50m","hus50m","ua100m","va100m","ua150m","va150m","sftlaf","sfturf","z0","wsgsmax","tsl","mrsol","mrsfl","CAPE","CIN","LI","mrfsos","mrsos"'
 
-    fname = dict2str('surf.{histfile}.000000')
+    fname = os.path.join(cwd, dict2str('surf.{histfile}.000000'))
     if check_var_in_file(fname,"od550aer") is True:
         d['hnames'] = dict2str('{hnames},"od550aer"')
     if check_var_in_file(fname,"anth_ave") is True:
@@ -3041,7 +5698,7 @@ def cc_template_cordex():
     if check_var_in_file(fname,"hailradave") is True:
         d['hnames'] = dict2str('{hnames},"hailradave","hailradmax"')
 
-    d['ktc_local'] = check_timestep_in_file(dict2str('surf.{histfile}.000000'))
+    d['ktc_local'] = check_timestep_in_file(os.path.join(cwd, dict2str('surf.{histfile}.000000')))
 
     template = """\
     &input
@@ -3065,18 +5722,18 @@ def cc_template_cordex():
     return template
 
 
-def cc_template_basic():
+def cc_template_basic(cwd='.'):
     "pcc2hist namelist for basic standard output"
 
     d['hnames'] = '"pr","ta","ts","ua","va","psl","tas","uas","vas","hurs","orog","tasmax","tasmin","sfcWind","zg","hus","qlg","qfg","wa","theta","omega","cfrac","prw","clwvi","clivi","zmla","ustar","clt","clh","clm","cll","rsds","rlds","rsus","rlus","prgr","prsn","sund","rsut","rlut","rsdt","hfls","hfss","CAPE","CIN","LI","prc","evspsbl","mrro","mrros","snm","hurs","huss","ps","tauu","tauv","snw","snc","snd","siconca","z0","evspsblpot","tdew","tsl","mrsol","mrsfl","alb","sftlf","grid","sdischarge","rnd24"'
     d['use_depth'] = 'F'
 
-    fname = dict2str('{histfile}.000000')
+    fname = os.path.join(cwd, dict2str('{histfile}.000000'))
     if check_var_in_file(fname,"thetao") is True:
         d['hnames'] = dict2str('{hnames},"tos","sos","uos","vos","zos","ocndepth"')
         d['use_depth'] = 'T'
 
-    d['ktc_local'] = check_timestep_in_file(dict2str('{histfile}.000000'))
+    d['ktc_local'] = check_timestep_in_file(os.path.join(cwd, dict2str('{histfile}.000000')))
 
     template = """\
     &input
@@ -3106,10 +5763,10 @@ def cc_template_basic():
     return template
 
 
-def cc_template_tracer():
+def cc_template_tracer(cwd='.'):
     "Tracer part of template for 'cc.nml' namelist file"
 
-    d['ktc_local'] = check_timestep_in_file(dict2str('{histfile}.000000'))
+    d['ktc_local'] = check_timestep_in_file(os.path.join(cwd, dict2str('{histfile}.000000')))
 
     template = """\
     &input
@@ -3134,7 +5791,8 @@ def cc_template_tracer():
     return template
 
 
-if __name__ == '__main__':
+def build_parser():
+    "Create the command line parser for run_ccam.py"
 
     extra_info = """
     Usage:
@@ -3226,6 +5884,20 @@ if __name__ == '__main__':
     parser.add_argument("--contact", type=str, help=" CCAM contact email")
     parser.add_argument("--rcm_version_id", type=str, help=" CCAM version number")
 
+    parser.add_argument("--aeromode", type=str, choices=['monthly', 'year', 'all'], default="monthly", help=" Create aerosol emissions for each month, the current year or all years (monthly, year, all)")
+    parser.add_argument("--vegmode", type=str, choices=['year', 'lookahead', 'all'], default="year", help=" Create land-use for the current year, also the next year in the background or all years (year, lookahead, all)")
+    parser.add_argument("--mesoprefetch", type=str, choices=['off', 'on'], default="off", help=" Stage the host file for the next month in the background (off, on)")
+    parser.add_argument("--surfcache", type=str, default="none", help=" Shared surface dataset cache directory (none=disabled)")
+    parser.add_argument("--stagecache", type=str, default="none", help=" Node-local staging directory for read-only input files of single node jobs (none=disabled)")
+    parser.add_argument("--stagesize", type=float, default=50., help=" Size budget of the staging directory in GB")
+    parser.add_argument("--localdir", type=str, default="none", help=" Node-local directory for the working directory (none=disabled)")
+    parser.add_argument("--slicecache", type=str, default="none", help=" Directory for yearly slices of GHG, solar, ozone and SST files (none=disabled)")
+    parser.add_argument("--postprocs", type=int, default=0, help=" Ranks for post-processing in the background while the model runs (0=off)")
+    parser.add_argument("--postindex", type=str, choices=['off', 'on', 'rebuild'], default="off", help=" Index of post-processed months in hdir (off, on, rebuild)")
+    parser.add_argument("--poststreams", type=str, choices=['serial', 'concurrent'], default="serial", help=" Post-process the standard, surface and high-frequency output one after the other or at the same time (serial, concurrent)")
+    parser.add_argument("--postmode", type=str, choices=['month', 'backlog'], default="month", help=" Post-process dmode=postprocess output month by month or all months and streams concurrently (month, backlog)")
+    parser.add_argument("--metacatalog", type=str, choices=['off', 'on'], default="off", help=" Cache NetCDF header metadata in hdir (off, on)")
+
     # special options for testing
     
     ###############################################################
@@ -3254,6 +5926,11 @@ if __name__ == '__main__':
 
     parser.add_argument("--sibveg", type=str, help="depreciated")
 
-    args = parser.parse_args()
+    return parser
+
+
+if __name__ == '__main__':
+
+    args = build_parser().parse_args()
 
     main(args)
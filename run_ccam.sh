@@ -107,6 +107,23 @@ vegindex=default                             # Define vegetation indices for use
 uservegfile=none                             # User specified vegetation map (none for no user file)
 userlaifile=none                             # User specified LAI map (none for no user file)
 
+###############################################################
+# Performance options
+
+metacatalog=off                              # cache NetCDF header metadata in hdir (off, on)
+surfcache=none                               # shared surface dataset cache directory (none=disabled)
+stagecache=none                              # node-local staging directory for read-only input files of single node jobs (none=disabled)
+stagesize=50                                 # size budget of the staging directory (GB)
+localdir=none                                # node-local working directory with copy-back to hdir (none=disabled)
+slicecache=none                              # directory for yearly slices of GHG, solar, ozone and SST files (none=disabled)
+postprocs=0                                  # ranks for post-processing in the background while the model runs (0=off)
+postindex=off                                # index of post-processed months in hdir (off, on, rebuild)
+poststreams=serial                           # post-process standard, surface and high-frequency output in turn or at the same time (serial, concurrent)
+postmode=month                               # post-process dmode=postprocess output by month or all months concurrently (month, backlog)
+aeromode=monthly                             # create aerosol emissions for each month, current year or all years (monthly, year, all)
+vegmode=year                                 # create land-use for the current year, also next year in background or all years (year, lookahead, all)
+mesoprefetch=off                             # stage the host file for the next month in the background (off, on)
+
 ###############################################################
 # Host atmosphere for dmode=nudging_gcm, nudging_ccam, sst_6hour
 # and soil data options
@@ -174,7 +191,12 @@ python $excdir/run_ccam.py --name $name --nproc $nproc --nnode $nnode \
 		   --drsmode $drsmode --drsdomain $drsdomain \
 		   --drsensemble $drsensemble --model_id "$model_id" \
 		   --contact "$contact" --rcm_version_id "$rcm_version_id" \
-                   --drsproject "$drsproject" --drshost $drshost
+                   --drsproject "$drsproject" --drshost $drshost \
+                   --metacatalog $metacatalog --surfcache $surfcache \
+                   --stagecache $stagecache --stagesize $stagesize --localdir $localdir \
+                   --slicecache $slicecache --postprocs $postprocs --postmode $postmode --postindex $postindex \
+                   --poststreams $poststreams \
+                   --aeromode $aeromode --vegmode $vegmode --mesoprefetch $mesoprefetch
 
 # Process instructions from python
 